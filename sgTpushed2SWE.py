@@ -47,169 +47,507 @@ SOFTWARE.
 
 import asyncio
 from asyncio.tasks import FIRST_COMPLETED
-import json
+import signal
 import sys
 import time
-from websockets import ConnectionClosed
-from ws_stomp import WebSocketStomp
 
-from sgTpushed2SWE_pxgrid import PxgridControl
-from sgTpushed2SWE_swe import SmcControl, IpCache, Speedo
+from sgTpushed2SWE_pxgrid import PxgridControl, PxgridSubscription, SessionFilter
+from sgTpushed2SWE_swe import Speedo, SmcTenant, TenantRouter
 from sgTpushed2SWE_args import Config
+from sgTpushed2SWE_log import log, INFO
+from sgTpushed2SWE_replay import ReplayStomp
+from sgTpushed2SWE_metrics import metrics
 
-def ipTagCache_cleanup(config,staleIPs, smc, ipTags):
+def ipTagCache_cleanup(config,staleIPs, smc, batcher, ipTags):
 
     if config.cache_remove_stale_ip():
         for IpAddr in staleIPs:
             tagId = ipTags.exists(IpAddr)
-            tagDetails = smc.tag_details(tagId)
-            tagName = tagDetails['name']
-            print("*  Stale IP ({}), removing it from tag {} - rate/s : {:.1f}.".format(IpAddr, tagName, smc.callRate() ), flush=True)
-            smc.delIpFromTag(tagId, tagDetails, IpAddr)
+            # the @IP is removed from all the SGT groups/tags it belongs to
+            tagIds = smc.sgtTagsCovering(IpAddr)
+            tagIds.add(tagId)
+            for tagId in tagIds:
+                log.info('stale', "*  Stale IP ({}), removing it from tagId {}.", IpAddr, tagId)
+                batcher.remove(tagId, IpAddr)
             ipTags.delete(IpAddr)
+            metrics.inc('cache_stale_evictions_total', ipTags.labels)
+
+"""
+    Removes @IPs from a tenant (tags/groups and cache) : the @IPs
+    are now routed to another tenant
+"""
+def ipTag_release(tenant, ipAddresses):
+    
+    smc, ipTags, batcher = tenant.smc, tenant.ipTags, tenant.batcher
+    for IpAddr in ipAddresses:
+        tagIds = smc.sgtTagsCovering(IpAddr)
+        cachedIpTag = ipTags.peek(IpAddr)
+        if cachedIpTag != None:
+            tagIds.add(cachedIpTag)
+        for tagId in tagIds:
+            log.info('tenant', "  @IP ({}) moved to another tenant, removed from {} tagId {}.", IpAddr, tenant.name, tagId)
+            batcher.remove(tagId, IpAddr)
+        ipTags.delete(IpAddr)
+
+async def tagBatch_flush(tenant):
+
+    batcher, ipTags, pending = tenant.batcher, tenant.ipTags, tenant.pending
+    results = await batcher.flush()
+    # @IPs changed by the consumers during the flush : the cache is newer than SMC
+    changed = batcher.changed()
+    for tagId, tagDetails, changes in results:
+        if 'ranges' in tagDetails:
+            #update the cache with @IPs found in SMC in the group/tag
+            ipTags.sync(tagId,tagDetails['ranges'], changed)
+        else:
+            for IpAddr, add in changes.items():
+                if add and ipTags.exists(IpAddr) == tagId:
+                    ipTags.delete(IpAddr) # in case sync is lost with SMC
+                    log.warning('batch', ' ## {}/{} update message not processed.', tagId, IpAddr)
+    
+    if log.enabled(INFO, 'queue'):
+        queueStats = pending.stats()
+        limiterStats = batcher.smc.limiter.stats()
+        log.info('queue', "* " + tenant.name + " pending queue : depth {depth} (max {max_depth}, held {held}), lag {lag:.2f}s, collapsed {collapsed}, flaps {flaps}, dropped {dropped}, wait {avg_wait:.2f}s (max {max_wait:.2f}s)".format(**queueStats) +
+            " - SMC rate limiter : {waits} waits, wait {avg_wait:.2f}s (max {max_wait:.2f}s).".format(**limiterStats))
 
 def key_enter_callback(event):
     sys.stdin.readline()
     event.set()   
 
-async def future_read_message(ws, future):
-    try:
-        message = await ws.stomp_read_message()
-        future.set_result(message)
-    except ConnectionClosed:
-        print('Websocket connection closed')
-
-async def subscribe_loop(config, secret, ws_url, topic, smc):
+"""
+    Number of SMC API calls made, all tenants
+"""
+def smc_calls():
+    return(sum(tenant.smc.callIndex() for tenant in tenants))
 
-    global ipTags
+"""
+    Routes the @IPs grouped by SGT to the tenants (TenantRouter) :
+    { tenant : { sgtName : [ IpAddr, ...] } } ; @IPs matching no tenant are ignored.
+"""
+def sgt_by_tenant(sgtIPs):
     
-    ws = WebSocketStomp(ws_url, config.ise_nodename(), secret, config.get_ssl_context())
-    await ws.connect()
-    await ws.stomp_connect(pubsub_node_name)
-    await ws.stomp_subscribe(topic)
+    tenantIPs = {}
+    for sgtName, ipAddresses in sgtIPs.items():
+        for IpAddr in ipAddresses:
+            tenant = router.route(IpAddr, sgtName)
+            if tenant == None:
+                log.info('tenant', "  @IP ({}) sgt {} matches no tenant, ignored.", IpAddr, sgtName)
+                metrics.inc('tenant_unrouted_total')
+                continue
+            tenantIPs.setdefault(tenant, {}).setdefault(sgtName, []).append(IpAddr)
+    return(tenantIPs)
+
+"""
+    An @IP routed to a tenant is released by the other tenants having
+    it (cached or pending) : a record without SGT is queued for them.
+"""
+def tenant_moves(tenant, IpAddr):
     
-    print("{TIME} ({Index of pxgrid msg}/{Index of SWE API calls made}) PxGrid -> sgt: {TAG} IPs: {IP} ")
+    for other in tenants:
+        if other is not tenant and (other.ipTags.peek(IpAddr) != None or IpAddr in other.pending):
+            other.pending.release(IpAddr)
+
+"""
+    pxgrid reader task : drains the messages from ws into the pending
+    queues of the tenants, without waiting for SMC. Returns at the end
+    of a replay (the pxgrid subscription reconnects in place).
+"""
+async def pxgrid_reader(config, ws):
     
     while True:
-        future = asyncio.Future()
-        future_read = future_read_message(ws, future)
-        await asyncio.wait([future_read], return_when=FIRST_COMPLETED)
+        try:
+            message = await ws.stomp_read_message()
+        except EOFError:
+            log.info('replay', 'End of the capture file')
+            return
+        except ValueError as e:
+            # malformed STOMP frame, skipped
+            log.warning('pxgrid', "## Malformed STOMP frame skipped : {}", e)
+            metrics.inc('pxgrid_decode_errors_total')
+            continue
         
-        message = json.loads(future.result())
-        session = message['sessions'][0]
-    
         pxRawRate.monitor()
+        metrics.inc('pxgrid_messages_total')
         
-        if 'ctsSecurityGroup' in session.keys() and 'ipAddresses' in session.keys() :
-            
-            now = int(time.time())
-            pxIpRate.monitor()
-            
-            ipAddresses = session['ipAddresses']
-            sgtName = session['ctsSecurityGroup']
+        # wanted sessions of the message (fast path filter), @IPs grouped by SGT
+        try:
+            sessions = sessionFilter.decode(message)
+        except (ValueError, TypeError) as e:
+            log.warning('pxgrid', "## Malformed pxgrid message skipped : {}", e)
+            metrics.inc('pxgrid_decode_errors_total')
+            continue
+        if len(sessions) == 0:
+            metrics.inc('pxgrid_filtered_total')
+        sgtIPs = sessions_by_sgt(sessions, pxIpRate)
+        
+        for sgtName, ipAddresses in sgtIPs.items():
+            if not log.enabled(INFO, 'pxgrid_event'):
+                continue
             tstamp = time.strftime("%H:%M:%S", time.gmtime())
-            listOfIPs = " ".join(ipAddresses)
-            print("{} ({}/{}) PxGrid -> sgt: {} IPs: {} rate {:.1f}/s|{:.1f}/s".format(tstamp,pxIpRate.index(),smc.callIndex(),sgtName,listOfIPs,pxRawRate.rate(), pxIpRate.rate()), flush=True)
+            log.info('pxgrid_event', "{} ({}/{}) PxGrid -> sgt: {} IPs: {} rate {:.1f}/s|{:.1f}/s", tstamp, pxIpRate.index(), smc_calls(), sgtName, " ".join(ipAddresses), pxRawRate.rate(), pxIpRate.rate())
+        
+        # records wait in the pending queue of their tenant until a consumer
+        # takes them ; a SGT change is held for the settle window (flap damping)
+        for tenant, tenantIPs in sgt_by_tenant(sgtIPs).items():
+            if liveIPs != None:
+                # bulk sync in progress, the live records are newer
+                for ipAddresses in tenantIPs.values():
+                    liveIPs.update(ipAddresses)
+            settleTime = tenant.config.settle_time()
+            for sgtName, ipAddresses in tenantIPs.items():
+                tagId = tenant.smc.tagIdFromName(sgtName)
+                for IpAddr in ipAddresses:
+                    # only a change of a known tag is held, not a first assignment
+                    cachedIpTag = tenant.ipTags.peek(IpAddr)
+                    hold = settleTime if cachedIpTag != None and cachedIpTag != tagId else 0
+                    tenant.pending.put(IpAddr, sgtName, hold)
+                    if len(tenants) > 1:
+                        tenant_moves(tenant, IpAddr)
+
+"""
+    Processes a batch of pending records (get_batch), grouped by SGT.
+    A SGT failing (SMC call exception) doesn't stop the others : the
+    error is logged and counted, its records are queued again after
+    SMC_BATCH_TIME (dropped if not retry).
+"""
+async def pending_batch(tenant, batch, retry = True):
+    
+    pending = tenant.pending
+    try:
+        for sgtName, ipAddresses in batch.items():
+            try:
+                await process_session(tenant, sgtName, ipAddresses)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.inc('smc_errors_total', { 'tenant' : tenant.name, 'stage' : 'pending' })
+                if retry:
+                    delay = tenant.config.smc_batch_time()
+                    log.error('queue', "### Error: sgt {}, {} @IPs not processed ({!r}), retried in {}s.", sgtName, len(ipAddresses), e, delay)
+                    for IpAddr in ipAddresses:
+                        pending.retry(IpAddr, sgtName, delay)
+                else:
+                    log.error('queue', "### Error: sgt {}, {} @IPs not processed ({!r}), dropped.", sgtName, len(ipAddresses), e)
+    finally:
+        pending.done(batch)
+
+"""
+    Consumer task : processes the pending records of a tenant as long
+    as its SMC capacity is available, until the pending queue is closed.
+"""
+async def pending_consumer(tenant):
+    
+    pending, limiter = tenant.pending, tenant.asyncSmc.limiter
+    while await pending.wait():
+        while limiter.available() < 1:
+            await asyncio.sleep(limiter.delay())
+        # records processed grouped by SGT : one tag lookup per SGT
+        batch = pending.get_batch(tenant.config.smc_batch_size())
+        await pending_batch(tenant, batch)
+
+"""
+    Delay before the loop has to wake up : pending batch to push,
+    or reconciliation (when no batch is pending : it runs after the flush)
+"""
+def loop_timeout(tenant):
+    
+    timeout = tenant.batcher.timeout()
+    if timeout != None:
+        return(timeout)
+    return(tenant.reconciler.timeout())
+
+"""
+    Groups the @IPs of pxgrid sessions (SessionRecords) by SGT : { sgtName : [ IpAddr, ...] }
+    Sessions rejected by the filter (None) are ignored, the others are counted.
+"""
+def sessions_by_sgt(sessions, sessionRate):
+    
+    sgtIPs = {}
+    for session in sessions:
+        if session != None:
+            sessionRate.monitor()
+            sgtIPs.setdefault(session.sgt, []).extend(session.ips)
+            metrics.inc('pxgrid_ips_total', value = len(session.ips))
+    return(sgtIPs)
+
+"""
+    Processes the @IPs bound to a SGT in a tenant : cache lookup, tag
+    creation if needed and @IP changes queued for the next batch.
+    Records without SGT release the @IPs (moved to another tenant).
+    @IPs in skip are ignored (checked after the tag creation).
+"""
+async def process_session(tenant, sgtName, ipAddresses, skip = ()):
+    
+    if sgtName == None:
+        # @IPs routed to another tenant
+        ipTag_release(tenant, ipAddresses)
+        return
+    
+    config, smc, ipTags, batcher, tagCreations = tenant.config, tenant.asyncSmc, tenant.ipTags, tenant.batcher, tenant.tagCreations
+    now = int(time.time())
+    
+    tagId = smc.tagIdFromName(sgtName) # tag/group name cache lookup
+    
+    if tagId == '':
+        # group/tag doesn't exit yet; needs to be created (once, when
+        # several consumers are waiting for it)
+        creation = tagCreations.get(sgtName)
+        if creation == None:
+            log.info('tag', "({}/{}) New tag ({}), creation in SMC - (rate/s : {:.1f}).", pxIpRate.index(), smc.callIndex(), sgtName, smc.callRate())
+            creation = asyncio.ensure_future(smc.createTag(sgtName)) # smc API; one query.
+            tagCreations[sgtName] = creation
+            creation.add_done_callback(lambda future: tagCreations.pop(sgtName, None))
+        tagId = await creation
+        if tagId == '':
+            # impossible to create
+            log.error('tag', "### Error: Impossible to create new tag ({}).", sgtName)
+            return
             
-            # SMC call rate limit verification
-            smcRate = smc.callRate()
-            if smcRate > config.smc_max_rate():
-                print(" *** SMC API max call rate reached ({:.1f}/s), cancelling pxgrid record ".format(smcRate))
-                continue
-                
-            tagId = smc.tagIdFromName(sgtName) # tag/group name cache lookup
+    for IpAddr in ipAddresses:
+        if IpAddr in skip:
+            continue
+        # for each IP address in the pxgrid message :
+        cachedIpTag = ipTags.exists(IpAddr) # cache IP lookup, could return None
+        if tagId != cachedIpTag: # actual group/tag in cache is unknown or different from received
+            # update the Tag cache
+            ipTags.update(IpAddr,tagId)
+            # the new Tag (group) is updated with the next batch
+            log.info('cache_miss', "  Tag ({}), {} queued for SMC update.", sgtName, IpAddr)
+            batcher.add(tagId, IpAddr)
             
-            if tagId == '':
-                # group/tag doesn't exit yet; needs to be created
-                print("({}/{}) New tag ({}), creation in SMC - (rate/s : {:.1f}).".format(pxIpRate.index(),smc.callIndex(),sgtName,smc.callRate()), flush=True)
-                tagId = smc.createTag(sgtName) # smc API; one query.
-                if tagId == '':
-                    # impossible to create
-                    print("### Error: Impossible to create new tag ({}).".format(sgtName), flush=True)
-                    continue
-                    
-            for IpAddr in ipAddresses:
-                if IpAddr == '':
-                    continue
-                # for each IP address in the pxgrid message :
-                cachedIpTag = ipTags.exists(IpAddr) # cache IP lookup, could return None
-                if tagId != cachedIpTag: # actual group/tag in cache is unknown or different from received
-                    # update the Tag cache
-                    ipTags.update(IpAddr,tagId)
-                    # retrieve the config of the new Tag (group)
-                    tagDetails = smc.tag_details(tagId) # smc API; one query
-                    
-                    if tagDetails == config.smc_unknown_tag() :
-                        print("### Error: Impossible to get the tagId ({}) details.".format(tagId), flush=True)
-                        ipTags.delete(IpAddr) # in case sync is lost with FMC
-                        print(' ## {}/{} update message not processed.'.format(sgtName,IpAddr))
-                        continue # no way to get the tag details;
-                    
-                    if 'ranges' in tagDetails:
-                        #update the cache with @IPs found in SMC in the group/tag
-                        ipTags.sync(tagId,tagDetails['ranges']) 
-                    
-                        if IpAddr in tagDetails['ranges']:
-                            age = int((now - ipTags.last(IpAddr))/60) # in minutes
-                            print("  Tag ({}), {} present in SMC (age {} min.) - rate/s : {:.1f}.".format(sgtName, IpAddr, age, smc.callRate() ), flush=True)
-                        else:
-                            print("  Tag ({}), {} not found in SMC, adding it - rate/s : {:.1f}.".format(sgtName, IpAddr,smc.callRate() ), flush=True)
-                            smc.addIp2Tag(tagId,tagDetails,IpAddr) # smc API; one query
-                    else:
-                        print('## Warning: missing  details for {}.'.format(tagId))
-                    
-                    if cachedIpTag != None: # @IP was present in another group/tag;
-                        # retrieve the config of the old Tag (group)
-                        tagDetails = smc.tag_details(cachedIpTag) # smc API; one query
-                        tagName = tagDetails['name']
-                        ipTags.sync(tagId,tagDetails['ranges']) #by the way, update the cache with all @IPs found
-                        if IpAddr in tagDetails['ranges']:
-                            print("  Old tag ({}), {} present in SMC, removing it - rate/s : {:.1f}.".format(tagName, IpAddr, smc.callRate() ), flush=True)
-                            smc.delIpFromTag(tagId,tagDetails,IpAddr)
-                        else:
-                            print("  Old tag ({}), {} not found in SMC, no change.".format(tagName, IpAddr ), flush=True)
+            # @IP present in other SGT groups/tags (from the cache or SMC)
+            oldTagIds = smc.sgtTagsCovering(IpAddr)
+            if cachedIpTag != None:
+                oldTagIds.add(cachedIpTag)
+            oldTagIds.discard(tagId)
+            for oldTagId in oldTagIds:
+                log.info('cache_miss', "  Old tag ({}), {} queued for removal.", oldTagId, IpAddr)
+                batcher.remove(oldTagId, IpAddr)
+
+        else: # known @IP, in the correct group/tag
+            if log.enabled(INFO, 'cache_hit'):
+                age = int((now - ipTags.last(IpAddr))/60) # in minutes
+                log.info('cache_hit', "  Tag ({}), @IP ({}) present in cache, no change (age {} min.).", sgtName, IpAddr, age)
+            ipTags.confirm(IpAddr) # reset the age in the cache.
         
-                else: # known @IP, in the correct group/tag
-                    age = int((now - ipTags.last(IpAddr))/60) # in minutes
-                    print("  Tag ({}), @IP ({}) present in cache, no change (age {} min.).".format(sgtName, IpAddr, age ), flush=True)
-                    ipTags.confirm(IpAddr) # reset the age in the cache.
-                
-                # cleaning up the ipTags cache
-                staleIPs = ipTags.review()
-                ipTagCache_cleanup(config, staleIPs, smc, ipTags)
-                        
+        # cleaning up the ipTags cache
+        staleIPs = ipTags.review()
+        ipTagCache_cleanup(config, staleIPs, smc, batcher, ipTags)
+
+"""
+    Processes the pending records of a tenant as long as its SMC
+    capacity is available (all of them if forced).
+"""
+async def pending_process(tenant, force = False):
+    
+    pending = tenant.pending
+    while len(pending) > 0 and (force or tenant.asyncSmc.limiter.available() >= 1):
+        # records processed grouped by SGT : one tag lookup per SGT
+        # (forced : last run, nothing retried)
+        batch = pending.get_batch(force = force)
+        await pending_batch(tenant, batch, retry = not force)
+        
+        if tenant.batcher.due():
+            await tagBatch_flush(tenant)
+
+"""
+    Initial synchronization of a tenant : the @IP changes go to its
+    batcher, pushed per tag by the tenant loop. The @IPs received live
+    since the subscription are skipped ; the loop isn't blocked for
+    more than SMC_BATCH_SIZE @IPs.
+"""
+async def bulk_sync_tenant(tenant, sgtIPs):
+    
+    size = tenant.config.smc_batch_size()
+    for sgtName, ipAddresses in sgtIPs.items():
+        for index in range(0, len(ipAddresses), size):
+            await process_session(tenant, sgtName, ipAddresses[index:index + size], liveIPs)
+            await asyncio.sleep(0)
+
+"""
+    Initial synchronization with the sessions already known by ISE,
+    while the subscription runs : the sessions are downloaded by
+    bulkSessions() in a thread, @IPs are grouped by SGT and routed
+    to the tenants (tenants in parallel).
+"""
+async def bulk_sync(config, bulkSessions):
+    
+    global liveIPs
+    
+    try:
+        loop = asyncio.get_event_loop()
+        sessions = await loop.run_in_executor(None, bulkSessions)
+        sessionRate = Speedo()
+        sgtIPs = sessions_by_sgt(sessions, sessionRate)
+        log.info('bulk', "* Bulk sync : {} sessions with SGT, {} SGTs, {} @IPs received live meanwhile.", sessionRate.index(), len(sgtIPs), len(liveIPs))
+        
+        await asyncio.gather(*[bulk_sync_tenant(tenant, tenantIPs) for tenant, tenantIPs in sgt_by_tenant(sgtIPs).items()])
+        log.info('bulk', "* Bulk sync done, {} SMC API calls.", smc_calls())
+    except Exception as e:
+        log.error('bulk', "### Error: Bulk sync failed ({}), live updates only.", e)
+    finally:
+        liveIPs = None
+
+"""
+    Worker of a tenant : PXGRID_CONSUMERS tasks process its pending
+    queue ; the loop pushes the batches, saves the cache and reconciles,
+    until the reader task ends.
+"""
+async def tenant_loop(tenant, reader):
+    
+    batcher, ipTags, pending, reconciler = tenant.batcher, tenant.ipTags, tenant.pending, tenant.reconciler
+    consumers = [asyncio.ensure_future(pending_consumer(tenant)) for index in range(tenant.config.pxgrid_consumers())]
+    
+    while True:
+        # wake up when the reader ends, when a batch starts (the timeout
+        # changes), when the pending batch is due or full, or for the reconciliation
+        batchWakeup = asyncio.ensure_future(batcher.wakeup.wait())
+        await asyncio.wait([reader, batchWakeup], timeout=loop_timeout(tenant), return_when=FIRST_COMPLETED)
+        batchWakeup.cancel()
+        batcher.wakeup.clear()
+        
+        if reader.done():
+            # connection closed, push the pending changes before leaving
+            pending.close()
+            await asyncio.wait(consumers)
+            await pending_process(tenant, force = True)
+            await tagBatch_flush(tenant)
+            await ipTags.snapshot(force = True)
+            return
+        
+        flushed = batcher.due()
+        if flushed:
+            await tagBatch_flush(tenant)
+        
+        await ipTags.snapshot()
+        
+        # cache / SMC reconciliation, when no change is waiting for SMC
+        # or right after a flush (never starved by a continuous traffic)
+        if reconciler.due() and (flushed or batcher.timeout() == None):
+            await reconciler.run()
+
+"""
+    Processes the pxgrid messages read from ws : the pxgrid subscription
+    (PxgridSubscription, reconnected in place when the websocket closes)
+    or a capture file replay (ReplayStomp)
+    A reader task fills the pending queues, each tenant has its own
+    worker (tenant_loop). The bulk sync (bulkSessions, see bulk_sync)
+    runs once subscribed : the changes made meanwhile are not lost.
+"""
+async def subscribe_loop(config, ws, bulkSessions = None):
+    
+    global liveIPs
+    
+    await ws.connect()
+    
+    log.info('pxgrid', "{TIME} ({Index of pxgrid msg}/{Index of SWE API calls made}) PxGrid -> sgt: {TAG} IPs: {IP} ")
+    
+    liveIPs = set() if bulkSessions != None else None
+    reader = asyncio.ensure_future(pxgrid_reader(config, ws))
+    workers = [asyncio.ensure_future(tenant_loop(tenant, reader)) for tenant in tenants]
+    if bulkSessions != None:
+        await bulk_sync(config, bulkSessions)
+    await asyncio.gather(*workers)
+    # the reader has ended : end of the replay, or an error (raised here)
+    if not reader.cancelled() and reader.exception() != None:
+        log.error('pxgrid', "### Error: pxgrid reader failed ({!r}).", reader.exception())
+    reader.result()
+
+
+"""
+    Creates the agent objects, shared as module globals by the
+    functions above (also used by the benchmark) : one SmcTenant
+    per SMC_TENANTS entry
+"""
+def agent_setup(config):
+    
+    global pxRawRate, pxIpRate, sessionFilter, tenants, router, liveIPs
+    
+    liveIPs = None # @IPs received during the bulk sync
+    
+    sessionFilter = SessionFilter(config)
+    pxRawRate = Speedo()
+    pxIpRate = Speedo()
+    tenants = [SmcTenant(tenantConfig) for tenantConfig in config.tenant_configs()]
+    for tenant in tenants:
+        tenant.ipTags.load()
+    router = TenantRouter(tenants)
+    
+    # gauges, read when /metrics is scraped (per tenant)
+    metrics.gauge('pxgrid_messages_rate', 'pxgrid messages per second, by window (seconds).',
+        lambda: [({ 'window' : window }, rate) for window, rate in pxRawRate.rates().items()])
+    metrics.gauge('pxgrid_ips_rate', '@IPs received per second, by window (seconds).',
+        lambda: [({ 'window' : window }, rate) for window, rate in pxIpRate.rates().items()])
+    metrics.gauge('smc_calls_rate', 'SMC API calls per second, by window (seconds).',
+        lambda: [({ 'tenant' : tenant.name, 'window' : window }, rate) for tenant in tenants for window, rate in tenant.smc.apiRate.rates().items()])
+    metrics.gauge('smc_calls_inflight', 'SMC API calls in progress.',
+        lambda: [({ 'tenant' : tenant.name }, tenant.asyncSmc.inflight) for tenant in tenants])
+    metrics.gauge('cache_entries', '@IPs in the IpCache.',
+        lambda: [({ 'tenant' : tenant.name }, len(tenant.ipTags.cache)) for tenant in tenants])
+    metrics.gauge('cache_memory_bytes', 'Approximate memory used by the IpCache.',
+        lambda: [({ 'tenant' : tenant.name }, tenant.ipTags.stats()['memory']) for tenant in tenants])
+    metrics.gauge('cache_review_seconds', 'Duration of the last IpCache review.',
+        lambda: [({ 'tenant' : tenant.name }, tenant.ipTags.stats()['duration']) for tenant in tenants])
+    metrics.gauge('cache_review_visited', 'Entries visited by the last IpCache review.',
+        lambda: [({ 'tenant' : tenant.name }, tenant.ipTags.stats()['visited']) for tenant in tenants])
+    metrics.gauge('cache_review_stale', 'Stale @IPs found by the last IpCache review.',
+        lambda: [({ 'tenant' : tenant.name }, tenant.ipTags.stats()['stale']) for tenant in tenants])
+    metrics.gauge('pending_depth', 'Records waiting in the pending queue.',
+        lambda: [({ 'tenant' : tenant.name }, len(tenant.pending)) for tenant in tenants])
+    metrics.gauge('pending_lag_seconds', 'Age of the oldest record in the pending queue.',
+        lambda: [({ 'tenant' : tenant.name }, tenant.pending.lag()) for tenant in tenants])
+    metrics.gauge('batch_changes', '@IP changes waiting for the next batch.',
+        lambda: [({ 'tenant' : tenant.name }, tenant.batcher.size) for tenant in tenants])
 
 if __name__ == '__main__':
 
     assert (sys.version_info >= (3, 6)), "Requires Python 3.6 min."
     
     config = Config()
+    log.configure(config)
+    log.start()
     pxgrid = PxgridControl(config)
-    pxRawRate = Speedo()
-    pxIpRate = Speedo()
-    smc = SmcControl(config)
-    ipTags = IpCache(config)
-
-    while pxgrid.account_activate()['accountState'] != 'ENABLED':
-        time.sleep(60)
-
-    # lookup for session service
-    service_lookup_response = pxgrid.service_lookup('com.cisco.ise.session')
-    service = service_lookup_response['services'][0]
-    pubsub_service_name = service['properties']['wsPubsubService']
-    topic = service['properties']['sessionTopic']
-
-    # lookup for pubsub service
-    service_lookup_response = pxgrid.service_lookup(pubsub_service_name)
-    pubsub_service = service_lookup_response['services'][0]
-    pubsub_node_name = pubsub_service['nodeName']
-    secret = pxgrid.get_access_secret(pubsub_node_name)['secret']
-    ws_url = pubsub_service['properties']['wsUrl']
-    
-    # authenticate to Stealthwatch and set SMC environment
-    smc.authenticate()
-    smc.get_tenantID()
-    smc.tagList()
-    smc.setSgtRootTags()
-
-    asyncio.get_event_loop().run_until_complete(subscribe_loop(config, secret, ws_url, topic, smc))
+    agent_setup(config)
+    asyncio.get_event_loop().run_until_complete(metrics.serve(config.metrics_address(), config.metrics_port()))
+
+    if config.replay_file() != None:
+        # capture file replayed in place of the pxgrid websocket, without ISE
+        ws = ReplayStomp(config.replay_file(), config.replay_speed())
+        for tenant in tenants:
+            tenant.batcher.latencies = []
+    else:
+        while pxgrid.account_activate()['accountState'] != 'ENABLED':
+            time.sleep(60)
+    
+        # lookup for session service
+        service_lookup_response = pxgrid.service_lookup('com.cisco.ise.session')
+        service = service_lookup_response['services'][0]
+        pubsub_service_name = service['properties']['wsPubsubService']
+        topic = service['properties']['sessionTopic']
+    
+        # pubsub service nodes, looked up again on each reconnection
+        ws = PxgridSubscription(config, pxgrid, pubsub_service_name, topic)
+        if config.capture_file() != None:
+            ws.start_capture(config.capture_file())
+    
+    # authenticate to Stealthwatch and set SMC environment, for each tenant
+    for tenant in tenants:
+        tenant.setup()
+
+    # initial synchronization with the existing sessions, once subscribed
+    bulkSessions = None
+    if config.pxgrid_bulk_sync() == 'yes' and config.replay_file() == None:
+        bulkSessions = lambda: list(pxgrid.get_sessions(service, sessionFilter.decoder))
+
+    # SIGTERM ends the loop like Ctrl-C : the capture file is closed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    smcCalls = smc_calls()
+    try:
+        asyncio.get_event_loop().run_until_complete(subscribe_loop(config, ws, bulkSessions))
+    finally:
+        if config.replay_file() == None:
+            ws.stop_capture()
+    
+    if config.replay_file() != None:
+        ws.report(smc_calls() - smcCalls, time.time(), [latency for tenant in tenants for latency in tenant.batcher.latencies])
@@ -48,11 +48,15 @@ from sgTpushed2SWE_conf import *
 class Config:
     def __init__(self):
         
+        self.ssl_context = None
         parser = argparse.ArgumentParser()
         parser.add_argument('--ise_user', help='ISE admin user')
         parser.add_argument('--ise_password', help='ISE admin password')
         parser.add_argument('--smc_user', help='SMC admin user')
         parser.add_argument('--smc_password', help='SMC admin password')
+        parser.add_argument('--capture', help='pxgrid messages captured into this file (gzip)')
+        parser.add_argument('--replay', help='pxgrid messages replayed from this capture file, without ISE')
+        parser.add_argument('--replay_speed', type=float, default=1.0, help='replay speed: 1 = captured pace, N = N times faster, 0 = max')
             
         self.config = parser.parse_args()
         
@@ -76,6 +80,11 @@ class Config:
             exit(0)
         else:
             self.config.smc_host = SMC_HOST
+        
+        if 'SMC_PROTOCOL' not in globals():
+            self.config.smc_protocol = 'https'
+        else:
+            self.config.smc_protocol = SMC_PROTOCOL
             
         if 'SMC_REAUTH' not in globals():
             print("Error: Missing SMC_REAUTH entry in configuration file.")
@@ -92,11 +101,66 @@ class Config:
         else:
             self.config.smc_max_rate = SMC_MAX_RATE
             
+        if 'SMC_MAX_BURST' not in globals():
+            self.config.smc_max_burst = self.config.smc_max_rate
+        else:
+            self.config.smc_max_burst = SMC_MAX_BURST
+        
+        if 'SMC_PENDING_SIZE' not in globals():
+            self.config.smc_pending_size = 100000
+        else:
+            self.config.smc_pending_size = SMC_PENDING_SIZE
+        
         if 'SMC_UNKNOWN_TAG' not in globals():
             self.config.smc_unknown_tag = {}
         else:
             self.config.smc_unknown_tag = SMC_UNKNOWN_TAG
         
+        if 'SMC_MAX_CONCURRENCY' not in globals():
+            self.config.smc_max_concurrency = 4
+        else:
+            self.config.smc_max_concurrency = SMC_MAX_CONCURRENCY
+        
+        if 'SMC_TAG_WORKERS' not in globals():
+            self.config.smc_tag_workers = self.config.smc_max_concurrency
+        else:
+            self.config.smc_tag_workers = SMC_TAG_WORKERS
+        
+        if 'SMC_TENANTS' not in globals():
+            self.config.smc_tenants = []
+        else:
+            self.config.smc_tenants = SMC_TENANTS
+        
+        if 'SETTLE_TIME' not in globals():
+            self.config.settle_time = 0
+        else:
+            self.config.settle_time = SETTLE_TIME
+        
+        if 'SETTLE_MAX_HOLD' not in globals():
+            self.config.settle_max_hold = 30
+        else:
+            self.config.settle_max_hold = SETTLE_MAX_HOLD
+        
+        if 'SMC_SHADOW_REFRESH' not in globals():
+            self.config.smc_shadow_refresh = 3600
+        else:
+            self.config.smc_shadow_refresh = SMC_SHADOW_REFRESH
+        
+        if 'SMC_CIDR_COMPACT' not in globals():
+            self.config.smc_cidr_compact = 'no'
+        else:
+            self.config.smc_cidr_compact = SMC_CIDR_COMPACT
+        
+        if 'SMC_BATCH_TIME' not in globals():
+            self.config.smc_batch_time = 2
+        else:
+            self.config.smc_batch_time = SMC_BATCH_TIME
+        
+        if 'SMC_BATCH_SIZE' not in globals():
+            self.config.smc_batch_size = 500
+        else:
+            self.config.smc_batch_size = SMC_BATCH_SIZE
+        
         if 'CACHE_CLEANUP_TIME' not in globals():
             print("Error: Missing CACHE_CLEANUP_TIME entry in configuration file.")
             print("  - in seconds / integer; ex: 1800")
@@ -118,6 +182,29 @@ class Config:
         else:
             self.config.cache_remove_stale_ip = CACHE_REMOVE_STALE_IP
         
+        if 'CACHE_SNAPSHOT_FILE' not in globals():
+            self.config.cache_snapshot_file = ''
+        else:
+            self.config.cache_snapshot_file = CACHE_SNAPSHOT_FILE
+        if self.config.replay != None:
+            # a replay starts from an empty cache and doesn't overwrite the snapshot
+            self.config.cache_snapshot_file = ''
+        
+        if 'CACHE_SNAPSHOT_TIME' not in globals():
+            self.config.cache_snapshot_time = 300
+        else:
+            self.config.cache_snapshot_time = CACHE_SNAPSHOT_TIME
+        
+        if 'RECONCILE_TIME' not in globals():
+            self.config.reconcile_time = 0
+        else:
+            self.config.reconcile_time = RECONCILE_TIME
+        
+        if 'RECONCILE_MAX_CALLS' not in globals():
+            self.config.reconcile_max_calls = 100
+        else:
+            self.config.reconcile_max_calls = RECONCILE_MAX_CALLS
+        
         if 'SMC_SGT_DEFAULT_PARENT' not in globals():
             print("Error: Missing SMC_SGT_DEFAULT_PARENT entry in configuration file.")
             print("  - string: SMC group name used as parent group by default ")
@@ -132,6 +219,51 @@ class Config:
         else:
             self.config.smc_sgt_parent_tags = SMC_SGT_PARENT_TAGS
                 
+        if 'LOG_FILE' not in globals():
+            self.config.log_file = ''
+        else:
+            self.config.log_file = LOG_FILE
+        
+        if 'LOG_FORMAT' not in globals():
+            self.config.log_format = 'text'
+        else:
+            self.config.log_format = LOG_FORMAT
+        
+        if 'LOG_LEVEL' not in globals():
+            self.config.log_level = 'INFO'
+        else:
+            self.config.log_level = LOG_LEVEL
+        
+        if 'LOG_MAX_BYTES' not in globals():
+            self.config.log_max_bytes = 0
+        else:
+            self.config.log_max_bytes = LOG_MAX_BYTES
+        
+        if 'LOG_BACKUPS' not in globals():
+            self.config.log_backups = 5
+        else:
+            self.config.log_backups = LOG_BACKUPS
+        
+        if 'LOG_SAMPLING' not in globals():
+            self.config.log_sampling = {}
+        else:
+            self.config.log_sampling = LOG_SAMPLING
+        
+        if 'LOG_QUEUE_SIZE' not in globals():
+            self.config.log_queue_size = 10000
+        else:
+            self.config.log_queue_size = LOG_QUEUE_SIZE
+        
+        if 'METRICS_ADDRESS' not in globals():
+            self.config.metrics_address = '127.0.0.1'
+        else:
+            self.config.metrics_address = METRICS_ADDRESS
+        
+        if 'METRICS_PORT' not in globals():
+            self.config.metrics_port = 0
+        else:
+            self.config.metrics_port = METRICS_PORT
+        
         if 'ISE_NODENAME' not in globals():
             print("Error: Missing ISE_NODENAME entry in configuration file.")
             print("  - string: name of the agent register into the pxgrid server")
@@ -161,6 +293,51 @@ class Config:
         else:
             self.config.ise_host = ISE_HOST
     
+        if 'PXGRID_BULK_SYNC' not in globals():
+            self.config.pxgrid_bulk_sync = 'no'
+        else:
+            self.config.pxgrid_bulk_sync = PXGRID_BULK_SYNC
+        
+        if 'PXGRID_CONSUMERS' not in globals():
+            self.config.pxgrid_consumers = 2
+        else:
+            self.config.pxgrid_consumers = PXGRID_CONSUMERS
+        
+        if 'PXGRID_RETRIES' not in globals():
+            self.config.pxgrid_retries = 3
+        else:
+            self.config.pxgrid_retries = PXGRID_RETRIES
+        
+        if 'PXGRID_BACKOFF' not in globals():
+            self.config.pxgrid_backoff = 1
+        else:
+            self.config.pxgrid_backoff = PXGRID_BACKOFF
+        
+        if 'PXGRID_BACKOFF_MAX' not in globals():
+            self.config.pxgrid_backoff_max = 60
+        else:
+            self.config.pxgrid_backoff_max = PXGRID_BACKOFF_MAX
+        
+        if 'PXGRID_TIMEOUT' not in globals():
+            self.config.pxgrid_timeout = 30
+        else:
+            self.config.pxgrid_timeout = PXGRID_TIMEOUT
+        
+        if 'PXGRID_SGT_ALLOW' not in globals():
+            self.config.pxgrid_sgt_allow = []
+        else:
+            self.config.pxgrid_sgt_allow = PXGRID_SGT_ALLOW
+        
+        if 'PXGRID_SGT_DENY' not in globals():
+            self.config.pxgrid_sgt_deny = []
+        else:
+            self.config.pxgrid_sgt_deny = PXGRID_SGT_DENY
+        
+        if 'PXGRID_REQUIRED_FIELDS' not in globals():
+            self.config.pxgrid_required_fields = ['ctsSecurityGroup', 'ipAddresses']
+        else:
+            self.config.pxgrid_required_fields = PXGRID_REQUIRED_FIELDS
+    
         if 'ISE_CLIENTCERT' not in globals():
             print("Error: Missing ISE_CLIENTCERT entry in configuration file.")
             print("  - string : path to the pxgrid agent cert file used to register to the ISE/pxgrid server (.crt format)")
@@ -197,6 +374,9 @@ class Config:
         
     def smc_host(self):
         return self.config.smc_host
+    
+    def smc_protocol(self):
+        return self.config.smc_protocol
         
     def smc_reauth(self):
         return self.config.smc_reauth
@@ -204,9 +384,56 @@ class Config:
     def smc_max_rate(self):
         return self.config.smc_max_rate
     
+    def smc_max_burst(self):
+        return self.config.smc_max_burst
+    
+    def smc_pending_size(self):
+        return self.config.smc_pending_size
+    
     def smc_unknown_tag(self):
         return self.config.smc_unknown_tag
     
+    def smc_max_concurrency(self):
+        return self.config.smc_max_concurrency
+    
+    def smc_tag_workers(self):
+        return self.config.smc_tag_workers
+    
+    def smc_tenants(self):
+        return self.config.smc_tenants
+    
+    # tenant (domain) ID or name, '' = the first one found (see TenantConfig)
+    def smc_tenant(self):
+        return ''
+    
+    def tenant_name(self):
+        return 'default'
+    
+    # one TenantConfig per SMC_TENANTS entry (a default one if none)
+    def tenant_configs(self):
+        entries = self.smc_tenants()
+        if len(entries) == 0:
+            return [TenantConfig(self, {}, False)]
+        return [TenantConfig(self, entry, len(entries) > 1) for entry in entries]
+    
+    def settle_time(self):
+        return self.config.settle_time
+    
+    def settle_max_hold(self):
+        return self.config.settle_max_hold
+    
+    def smc_shadow_refresh(self):
+        return self.config.smc_shadow_refresh
+    
+    def smc_cidr_compact(self):
+        return self.config.smc_cidr_compact
+    
+    def smc_batch_time(self):
+        return self.config.smc_batch_time
+    
+    def smc_batch_size(self):
+        return self.config.smc_batch_size
+    
     def cache_cleanup_time(self):
         return self.config.cleanup_time
     
@@ -216,12 +443,60 @@ class Config:
     def cache_remove_stale_ip(self):
         return self.config.cache_remove_stale_ip
     
+    def cache_snapshot_file(self):
+        return self.config.cache_snapshot_file
+    
+    def cache_snapshot_time(self):
+        return self.config.cache_snapshot_time
+    
+    def reconcile_time(self):
+        return self.config.reconcile_time
+    
+    def reconcile_max_calls(self):
+        return self.config.reconcile_max_calls
+    
     def smc_sgt_default_parent(self):
         return self.config.smc_sgt_default_parent
     
     def smc_sgt_parent_tags(self):
         return self.config.smc_sgt_parent_tags
     
+    def log_file(self):
+        return self.config.log_file
+    
+    def log_format(self):
+        return self.config.log_format
+    
+    def log_level(self):
+        return self.config.log_level
+    
+    def log_max_bytes(self):
+        return self.config.log_max_bytes
+    
+    def log_backups(self):
+        return self.config.log_backups
+    
+    def log_sampling(self):
+        return self.config.log_sampling
+    
+    def log_queue_size(self):
+        return self.config.log_queue_size
+    
+    def capture_file(self):
+        return self.config.capture
+    
+    def replay_file(self):
+        return self.config.replay
+    
+    def replay_speed(self):
+        return self.config.replay_speed
+    
+    def metrics_address(self):
+        return self.config.metrics_address
+    
+    def metrics_port(self):
+        return self.config.metrics_port
+    
     def ise_nodename(self):
         return self.config.ise_nodename
     
@@ -234,6 +509,33 @@ class Config:
     def ise_host(self):
         return self.config.ise_host
     
+    def pxgrid_bulk_sync(self):
+        return self.config.pxgrid_bulk_sync
+    
+    def pxgrid_consumers(self):
+        return self.config.pxgrid_consumers
+    
+    def pxgrid_retries(self):
+        return self.config.pxgrid_retries
+    
+    def pxgrid_backoff(self):
+        return self.config.pxgrid_backoff
+    
+    def pxgrid_backoff_max(self):
+        return self.config.pxgrid_backoff_max
+    
+    def pxgrid_timeout(self):
+        return self.config.pxgrid_timeout
+    
+    def pxgrid_sgt_allow(self):
+        return self.config.pxgrid_sgt_allow
+    
+    def pxgrid_sgt_deny(self):
+        return self.config.pxgrid_sgt_deny
+    
+    def pxgrid_required_fields(self):
+        return self.config.pxgrid_required_fields
+    
     def ise_client_cert(self):
         return self.ise_client_cert
     
@@ -246,11 +548,56 @@ class Config:
     def ise_server_cert(self):
         return self.config.ise_server_cert
         
+    # the context is built once (certs read from disk), then shared
     def get_ssl_context(self):
+        if self.ssl_context is not None:
+            return self.ssl_context
         context = ssl.create_default_context()
         if self.config.ise_client_cert is not None:
             context.load_cert_chain(certfile=self.config.ise_client_cert,
                                     keyfile=self.config.ise_client_key,
                                     password=self.config.ise_client_key_password)
         context.load_verify_locations(cafile=self.config.ise_server_cert)
+        self.ssl_context = context
         return context
+
+
+"""
+    ---------------------------------------------------------------------------------
+    TenantConfig Class : options of a SMC tenant (domain), from a SMC_TENANTS entry
+
+    Same getters as Config ; the options defined in the entry (getter
+    names, e.g. 'smc_max_rate' : 10) override the global ones.
+    With several tenants, each one has its own cache snapshot file
+    (CACHE_SNAPSHOT_FILE suffixed with the tenant name).
+    ---------------------------------------------------------------------------------
+"""
+class TenantConfig:
+    def __init__(self, config, entry, shared):
+        self.base = config
+        self.entry = entry
+        self.shared = shared
+    
+    def __getattr__(self, name):
+        if name in self.entry:
+            value = self.entry[name]
+            return lambda: value
+        return getattr(self.base, name)
+    
+    def smc_tenant(self):
+        return str(self.entry.get('tenant', ''))
+    
+    def tenant_name(self):
+        return self.smc_tenant() or 'default'
+    
+    def tenant_prefixes(self):
+        return self.entry.get('prefixes', [])
+    
+    def tenant_sgts(self):
+        return self.entry.get('sgts', [])
+    
+    def cache_snapshot_file(self):
+        filename = self.entry.get('cache_snapshot_file', self.base.cache_snapshot_file())
+        if filename == '' or not self.shared or 'cache_snapshot_file' in self.entry:
+            return filename
+        return filename + '.' + self.tenant_name()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+This script benchmarks sgTpushed2SWE.py against the SMC simulator.
+
+pxgrid events (a capture file, or synthetic events) are replayed into
+the agent loop, the SMC API calls are served by the simulator
+(sgTpushed2SWE_smcsim.py) started in process.
+The SMC calls per event and the sustained events/s are reported and
+checked against the given limits, and the final SMC state is checked :
+each @IP in the tag/group of its last SGT only (exit code 1 if not met) :
+
+  python sgTpushed2SWE_bench.py --events 20000 --ips 5000 --max_calls_per_event 0.05 --min_events_rate 500
+
+The SMC options (rate limit, batching ...) are read from sgTpushed2SWE_conf.py,
+the SMC host and protocol are replaced by the simulator ones.
+ -
+
+"""
+
+__author__      = "Jean-Francois Pujol, Cisco Switzerland"
+__copyright__   = "MIT License. Copyright (c) 2020 Cisco and/or its affiliates."
+__version__     = 1.0
+
+"""
+Copyright (c) 2019, Cisco Systems, Inc. All rights reserved.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import sgTpushed2SWE as agent
+from sgTpushed2SWE_args import Config
+from sgTpushed2SWE_log import log
+from sgTpushed2SWE_replay import ReplayStomp, read_capture
+from sgTpushed2SWE_smcsim import SmcSimulator, parse_errors
+from sgTpushed2SWE_swe import expand_ranges
+
+"""
+    Writes a capture file of synthetic pxgrid events : one session per
+    message, @IPs picked among 'ips' addresses, SGTs among 'sgts' names,
+    'rate' events per second
+"""
+def synthetic_capture(filename, events, ips, sgts, rate):
+
+    tick = time.time()
+    with gzip.open(filename, 'wt', encoding='utf-8') as capture:
+        for index in range(events):
+            host = random.randrange(ips)
+            session = {
+                'ctsSecurityGroup' : 'BENCH_SGT_{}'.format(random.randrange(sgts)),
+                'ipAddresses' : [ '10.{}.{}.{}'.format(host >> 16 & 255, host >> 8 & 255, host & 255) ]
+            }
+            message = json.dumps({ 'sessions' : [ session ] })
+            capture.write(json.dumps({ 'time' : tick + index / rate, 'message' : message }) + '\n')
+
+"""
+    Correctness of the final SMC state : each @IP of the capture (wanted
+    sessions) must be in exactly one tag/group, all tenants included,
+    named after its last SGT ; no other @IP. Returns the mismatches
+    [ (IpAddr, expected sgtName, [ tag names found ]) ]
+"""
+def check_state(captureFile, sessionFilter, tags):
+
+    expected = {}
+    for tick, message in read_capture(captureFile):
+        try:
+            sessions = sessionFilter.decode(message)
+        except (ValueError, TypeError):
+            continue
+        for session in sessions:
+            for IpAddr in session.ips:
+                expected[IpAddr] = session.sgt
+    found = {}
+    for tenantTags in tags.values():
+        for tag in tenantTags.values():
+            for IpAddr in expand_ranges(tag.get('ranges', [])):
+                found.setdefault(IpAddr, []).append(tag['name'])
+    mismatches = [(IpAddr, sgtName, found.get(IpAddr, [])) for IpAddr, sgtName in expected.items() if found.get(IpAddr) != [sgtName]]
+    mismatches.extend((IpAddr, None, tagNames) for IpAddr, tagNames in found.items() if IpAddr not in expected)
+    return(mismatches)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='sgTpushed2SWE benchmark against the SMC simulator')
+    parser.add_argument('--capture', help='capture file replayed (default : synthetic events)')
+    parser.add_argument('--events', type=int, default=10000, help='number of synthetic events')
+    parser.add_argument('--ips', type=int, default=2000, help='number of distinct @IPs in synthetic events')
+    parser.add_argument('--sgts', type=int, default=10, help='number of distinct SGTs in synthetic events')
+    parser.add_argument('--rate', type=float, default=1000.0, help='synthetic events per second (captured pace)')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed: 1 = captured pace, N = N times faster, 0 = max')
+    parser.add_argument('--latency', type=float, default=0.02, help='SMC simulator latency (seconds)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='SMC simulator latency jitter (seconds)')
+    parser.add_argument('--error', action='append', help='SMC simulator injected error, code:probability, repeatable')
+    parser.add_argument('--max_rate', type=int, default=0, help='SMC simulator rate limit (429 above), 0 = no limit')
+    parser.add_argument('--tenants', type=int, default=1, help='SMC simulator tenants, synthetic SGTs spread over them')
+    parser.add_argument('--max_calls_per_event', type=float, help='fails if more SMC calls per event')
+    parser.add_argument('--min_events_rate', type=float, help='fails if less events per second')
+    parser.add_argument('--log_level', default='WARNING', help='agent log level')
+    args = parser.parse_args()
+
+    captureFile = args.capture
+    if captureFile == None:
+        captureFile = os.path.join(tempfile.mkdtemp(), 'bench_capture.gz')
+        synthetic_capture(captureFile, args.events, args.ips, args.sgts, args.rate)
+
+    # agent configuration : sgTpushed2SWE_conf.py, SMC replaced by the simulator
+    sys.argv = [ sys.argv[0], '--replay', captureFile, '--replay_speed', str(args.speed) ]
+    config = Config()
+    rootTags = [ config.smc_sgt_default_parent() ] + list(config.smc_sgt_parent_tags().values())
+    sim = SmcSimulator(args.latency, args.jitter, None, args.max_rate, rootTags, args.tenants)
+    port = sim.start()
+    config.config.smc_host = '127.0.0.1:{}'.format(port)
+    # SGTs routed to the tenants (round robin), the last one takes the others
+    config.config.smc_tenants = []
+    if args.tenants > 1:
+        config.config.smc_tenants = [ { 'tenant' : 'simulator-{}'.format(index + 1),
+            'sgts' : [ 'BENCH_SGT_{}'.format(sgt) for sgt in range(index, args.sgts, args.tenants) ] } for index in range(args.tenants - 1) ]
+        config.config.smc_tenants.append({ 'tenant' : 'simulator-{}'.format(args.tenants) })
+    config.config.smc_protocol = 'http'
+    config.config.metrics_port = 0
+    config.config.log_level = args.log_level
+    log.configure(config)
+    log.start()
+
+    agent.agent_setup(config)
+    for tenant in agent.tenants:
+        tenant.setup()
+        tenant.batcher.latencies = []
+
+    # errors injected once the agent has started
+    sim.errors = parse_errors(args.error)
+    ws = ReplayStomp(captureFile, args.speed)
+    startCalls = sim.stats()['calls']
+    asyncio.get_event_loop().run_until_complete(agent.subscribe_loop(config, ws))
+    end = time.time() # all the events pushed to SMC
+    stats = sim.stats()
+    mismatches = check_state(captureFile, agent.sessionFilter, sim.tags)
+    sim.stop()
+    log.stop()
+
+    # results
+    calls = stats['calls'] - startCalls
+    events = agent.pxIpRate.index()
+    duration = max(end - (ws.start or end), 0.000001)
+    callsPerEvent = calls / events if events else 0.0
+    eventsRate = events / duration
+    ws.report(calls, end, [latency for tenant in agent.tenants for latency in tenant.batcher.latencies])
+    print("* Benchmark : {} events ({} messages) in {:.2f}s, {:.1f} events/s, {} SMC calls, {:.4f} calls/event.".format(
+        events, ws.index, duration, eventsRate, calls, callsPerEvent), flush=True)
+    print("  SMC simulator : {}".format(stats), flush=True)
+
+    failed = False
+    if len(mismatches) > 0:
+        print("## FAIL : {} @IPs not in (only) the tag of their last SGT, e.g. {}.".format(len(mismatches), mismatches[:3]), flush=True)
+        failed = True
+    if args.max_calls_per_event != None and callsPerEvent > args.max_calls_per_event:
+        print("## FAIL : {:.4f} SMC calls/event > {}.".format(callsPerEvent, args.max_calls_per_event), flush=True)
+        failed = True
+    if args.min_events_rate != None and eventsRate < args.min_events_rate:
+        print("## FAIL : {:.1f} events/s < {}.".format(eventsRate, args.min_events_rate), flush=True)
+        failed = True
+    if not failed:
+        print("* PASS", flush=True)
+    sys.exit(1 if failed else 0)
@@ -44,6 +44,7 @@ SOFTWARE.
 SMC_USER = "admin" # used to post info by API calls
 SMC_PASSWORD = "my_password"
 SMC_HOST = "my.smcserver.ch"
+SMC_PROTOCOL = "https" # https, or http for the SMC simulator (sgTpushed2SWE_smcsim.py)
 
 SMC_SGT_DEFAULT_PARENT = "TAGS" # SMC default root tag name
 SMC_SGT_PARENT_TAGS = { 'Dot1Xdesktops' : 'Trusted Users', # 'SGT name' : 'SMC parent tag/group name'
@@ -53,9 +54,38 @@ SMC_SGT_PARENT_TAGS = { 'Dot1Xdesktops' : 'Trusted Users', # 'SGT name' : 'SMC p
                         'GuestPostAuth' : 'Guest Wireless' ,
                         'GuestPreAuth' : 'Guest Wireless'
                         }
+SMC_TENANTS = [] # [] = first tenant (domain) found, or one entry per tenant (ID or name) :
+# the first entry matching an @IP ('prefixes' and/or 'sgts', none = any) gets it ;
+# options can be overridden per tenant (e.g. 'smc_max_rate' : its own SMC rate budget)
+# SMC_TENANTS = [ { 'tenant' : 'Campus', 'prefixes' : ['10.1.0.0/16', '10.2.0.0/16'] },
+#                 { 'tenant' : 'Guests', 'sgts' : ['GuestPreAuth', 'GuestPostAuth'], 'smc_max_rate' : 5 },
+#                 { 'tenant' : 'Default' } ]
 SMC_REAUTH = 1500 # max time before re-auth, in seconds
 SMC_MAX_RATE = 20 # max number of smc API access (/sec)
+SMC_MAX_BURST = 20 # max number of smc API access allowed in a burst, above SMC_MAX_RATE
+SMC_PENDING_SIZE = 100000 # max number of pxgrid records (@IPs) waiting for SMC capacity
 SMC_UNKNOWN_TAG = { } # empty list by default.
+SMC_MAX_CONCURRENCY = 4 # max number of smc API calls running in parallel
+SMC_TAG_WORKERS = 4 # number of tags/groups updated in parallel (tags sharded by tagId)
+SMC_SHADOW_REFRESH = 3600 # max age of the local copy of a tag/group before fetching it again from SMC (in seconds)
+SMC_CIDR_COMPACT = "no" # yes or no; yes = @IPs of a tag/group sent to SMC as CIDR blocks
+SMC_BATCH_TIME = 2 # max delay before pending @IP changes are pushed to a tag (in seconds)
+SMC_BATCH_SIZE = 500 # max number of pending @IP changes before pushing them to SMC
+SETTLE_TIME = 5 # in seconds, SGT changes of an @IP held before being pushed (flap damping), 0 to disable
+SETTLE_MAX_HOLD = 30 # in seconds, max time an @IP changing SGT repeatedly is held
+
+# LOGGING
+LOG_FILE = "" # "" = stdout, or log file name (rotated by size)
+LOG_FORMAT = "text" # text or json (JSON lines)
+LOG_LEVEL = "INFO" # DEBUG, INFO, WARNING or ERROR
+LOG_MAX_BYTES = 50000000 # log file rotation size, 0 = no rotation
+LOG_BACKUPS = 5 # number of rotated log files kept
+LOG_SAMPLING = { 'cache_hit' : 100 } # category : keep 1 record out of N, 0 = suppressed
+LOG_QUEUE_SIZE = 10000 # max number of records waiting to be written
+
+# METRICS (Prometheus format, http://<METRICS_ADDRESS>:<METRICS_PORT>/metrics)
+METRICS_ADDRESS = "127.0.0.1" # local only ; "0.0.0.0" to expose the metrics (tenants, ISE hosts) on all interfaces
+METRICS_PORT = 9108 # 0 to disable
 
 # ISE
 ISE_NODENAME = "p_agent"
@@ -66,11 +96,26 @@ ISE_CLIENTCERT = "./certs/sgTsubscribe2SWE_172.16.90.9.cer"
 ISE_CLIENTKEY = "./certs/sgTsubscribe2SWE_172.16.90.9.key"
 ISE_CLIENTKEYPASSWORD = "keycert_password_if_any"
 ISE_SERVERCERT = "./certs/iserollelabch.crt"
+PXGRID_BULK_SYNC = "yes" # yes or no; yes = load the existing sessions from ISE at startup (once subscribed, live changes win)
+PXGRID_CONSUMERS = 2 # number of tasks processing the pxgrid records
+PXGRID_RETRIES = 3 # rounds over all the ISE_HOST entries before a pxgrid control call fails
+PXGRID_BACKOFF = 1 # in seconds, first delay before retrying a failed ISE host (doubled on each failure)
+PXGRID_BACKOFF_MAX = 60 # in seconds, max retry delay
+PXGRID_TIMEOUT = 30 # in seconds, pxgrid control call timeout
+PXGRID_SGT_ALLOW = [] # SGT names processed, [] = all
+PXGRID_SGT_DENY = [] # SGT names ignored
+PXGRID_REQUIRED_FIELDS = ['ctsSecurityGroup', 'ipAddresses'] # sessions without these fields are ignored
 
 # IP / TAG CACHE
 CACHE_CLEANUP_TIME = 1800 # in seconds
 CACHE_STALE_IP = 36000 # entry suppression after (in seconds)
 CACHE_REMOVE_STALE_IP = "yes" # yes or no
+CACHE_SNAPSHOT_FILE = "sgTpushed2SWE_cache.db" # cache saved for warm restarts ("" to disable)
+CACHE_SNAPSHOT_TIME = 300 # in seconds
+
+# CACHE / SMC RECONCILIATION
+RECONCILE_TIME = 3600 # in seconds, 0 to disable
+RECONCILE_MAX_CALLS = 100 # max number of smc API access per reconciliation
 
 
 
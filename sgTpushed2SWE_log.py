@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+This script provides the logging pipeline of sgTpushed2SWE.py.
+
+Log records are queued by the caller (one non blocking enqueue) and
+formatted / written by a background thread, as text or JSON lines,
+to stdout or to a file rotated by size.
+Records of a category can be sampled (1 out of N) or suppressed.
+
+Options are defined in sgTpushed2SWE_conf.py file (LOG_xxx).
+ -
+
+"""
+
+__author__      = "Jean-Francois Pujol, Cisco Switzerland"
+__copyright__   = "MIT License. Copyright (c) 2020 Cisco and/or its affiliates."
+__version__     = 1.0
+
+"""
+Copyright (c) 2019, Cisco Systems, Inc. All rights reserved.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = { 'DEBUG' : DEBUG, 'INFO' : INFO, 'WARNING' : WARNING, 'ERROR' : ERROR }
+LEVEL_NAMES = { value : name for name, value in LEVELS.items() }
+
+"""
+    ---------------------------------------------------------------------------------
+
+    EventLog Class : asynchronous, rate aware logging
+
+     - debug() / info() / warning() / error() (category, format, args...)
+       queue a record ; formatting is done by the writer thread
+     - enabled(level, category) tells if the next record would be written :
+       checked first on the hot path, the arguments of a record suppressed
+       or sampled out are not even computed
+     - start() starts the writer thread, stop() flushes and stops it.
+       Until started, records are written directly (stdout).
+
+    Sampling : { category : N } keeps 1 record out of N, 0 suppresses
+    the category ; the number of records skipped is reported with the
+    next record written.
+
+    ---------------------------------------------------------------------------------
+"""
+class EventLog:
+    def __init__(self):
+        self.level = INFO
+        self.format = 'text'
+        self.filename = ''
+        self.max_bytes = 0
+        self.backups = 0
+        self.sampling = {}
+        self.skipped = {}
+        self.queue = queue.Queue(10000)
+        self.dropped = 0
+        self.thread = None
+        self.out = sys.stdout
+
+    """
+        Applies the LOG_xxx options
+    """
+    def configure(self, config):
+        self.level = LEVELS.get(config.log_level(), INFO)
+        self.format = config.log_format()
+        self.filename = config.log_file()
+        self.max_bytes = config.log_max_bytes()
+        self.backups = config.log_backups()
+        self.sampling = dict(config.log_sampling())
+        self.queue = queue.Queue(config.log_queue_size())
+
+    def start(self):
+        if self.thread != None:
+            return
+        if self.filename != '':
+            self.out = open(self.filename, 'a')
+        self.thread = threading.Thread(target=self._writer, name='log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.thread == None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        if self.out is not sys.stdout:
+            self.out.close()
+            self.out = sys.stdout
+
+    def debug(self, category, message, *args):
+        self.log(DEBUG, category, message, *args)
+
+    def info(self, category, message, *args):
+        self.log(INFO, category, message, *args)
+
+    def warning(self, category, message, *args):
+        self.log(WARNING, category, message, *args)
+
+    def error(self, category, message, *args):
+        self.log(ERROR, category, message, *args)
+
+    """
+        Checks the level and the sampling of a record before its arguments
+        are computed : a record sampled out is counted as skipped, as by log()
+        (call log() only if True)
+    """
+    def enabled(self, level, category):
+
+        if level < self.level:
+            return(False)
+        rate = self.sampling.get(category)
+        if rate == None or level >= WARNING:
+            return(True)
+        count = self.skipped.get(category, 0)
+        if rate == 0 or count + 1 < rate:
+            self.skipped[category] = count + 1
+            return(False)
+        return(True)
+
+    """
+        Queues a record (hot path : level and sampling checks, one enqueue)
+    """
+    def log(self, level, category, message, *args):
+
+        if level < self.level:
+            return
+        rate = self.sampling.get(category)
+        skipped = 0
+        if rate != None and level < WARNING:
+            count = self.skipped.get(category, 0)
+            if rate == 0 or count + 1 < rate:
+                self.skipped[category] = count + 1
+                return
+            skipped = count
+            self.skipped[category] = 0
+
+        record = (time.time(), level, category, skipped, message, args)
+        if self.thread == None:
+            self._write(record)
+            self.out.flush()
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _format(self, record):
+
+        tick, level, category, skipped, message, args = record
+        text = message.format(*args) if len(args) > 0 else message
+        if self.format == 'json':
+            entry = {
+                'time' : time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(tick)) + '.{:03d}Z'.format(int(tick * 1000) % 1000),
+                'level' : LEVEL_NAMES[level],
+                'category' : category,
+                'message' : text
+            }
+            if skipped > 0:
+                entry['skipped'] = skipped
+            return(json.dumps(entry) + '\n')
+        if skipped > 0:
+            text += ' ({} similar skipped)'.format(skipped)
+        return(text + '\n')
+
+    def _write(self, record):
+        self.out.write(self._format(record))
+
+    """
+        Renames the log file into .1, .2 ... when it reaches max_bytes
+    """
+    def _rotate(self):
+
+        if self.filename == '' or self.max_bytes == 0:
+            return
+        if self.out.tell() < self.max_bytes:
+            return
+        self.out.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = '{}.{}'.format(self.filename, index)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self.filename, index + 1))
+        if self.backups > 0:
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self.out = open(self.filename, 'a')
+
+    def _writer(self):
+
+        while True:
+            record = self.queue.get()
+            if record == None:
+                self.out.flush()
+                return
+            try:
+                self._write(record)
+                if self.dropped > 0:
+                    dropped = self.dropped
+                    self.dropped = 0
+                    self._write((time.time(), WARNING, 'log', 0, 'Log queue full, {} records dropped.', (dropped,)))
+                if self.queue.empty():
+                    self.out.flush()
+                self._rotate()
+            except Exception as e:
+                sys.stderr.write('Log writer error: {}\n'.format(e))
+
+log = EventLog()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+This script provides the metrics of sgTpushed2SWE.py.
+
+Counters, gauges and histograms are exposed in the Prometheus text
+format on http://<METRICS_ADDRESS>:<METRICS_PORT>/metrics, served
+from the asyncio loop of the main script.
+
+Options are defined in sgTpushed2SWE_conf.py file (METRICS_xxx).
+ -
+
+"""
+
+__author__      = "Jean-Francois Pujol, Cisco Switzerland"
+__copyright__   = "MIT License. Copyright (c) 2020 Cisco and/or its affiliates."
+__version__     = 1.0
+
+"""
+Copyright (c) 2019, Cisco Systems, Inc. All rights reserved.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import asyncio
+import threading
+
+PREFIX = 'sgtpushed2swe_'
+
+# SMC call latency buckets (in seconds)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+"""
+    Returns the Prometheus label string of a label dict
+"""
+def format_labels(labels):
+
+    if not labels:
+        return('')
+    pairs = []
+    for name, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return('{' + ','.join(pairs) + '}')
+
+"""
+    ---------------------------------------------------------------------------------
+
+    Metrics Class : counters, gauges and histograms
+
+     - inc(name, labels) increments a counter
+     - observe(name, value, labels) adds a value to a histogram
+     - gauge(name, help, callback) registers a gauge, read at each scrape;
+       the callback returns a value or a list of (labels, value)
+     - render() returns all the metrics in the Prometheus text format
+     - serve(address, port) starts the HTTP endpoint on the asyncio loop
+
+    Counters and histograms are updated from the loop and from the SMC
+    thread pool, updates are protected by a lock.
+    Values are kept per label set : { name : { labels tuple : value } }
+
+    ---------------------------------------------------------------------------------
+"""
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.types = {}
+        self.counters = {}
+        self.histograms = {}
+        self.buckets = {}
+        self.gauges = {}
+        self.server = None
+
+    def counter(self, name, help):
+        self.help[name] = help
+        self.types[name] = 'counter'
+        self.counters.setdefault(name, {})
+
+    def histogram(self, name, help, buckets = LATENCY_BUCKETS):
+        self.help[name] = help
+        self.types[name] = 'histogram'
+        self.buckets[name] = buckets
+        self.histograms.setdefault(name, {})
+
+    def gauge(self, name, help, callback):
+        self.help[name] = help
+        self.types[name] = 'gauge'
+        self.gauges[name] = callback
+
+    def inc(self, name, labels = None, value = 1):
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            values = self.counters[name]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, labels = None):
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            values = self.histograms[name]
+            if key not in values:
+                values[key] = { 'buckets' : [0] * len(self.buckets[name]), 'sum' : 0.0, 'count' : 0 }
+            entry = values[key]
+            for index, bound in enumerate(self.buckets[name]):
+                if value <= bound:
+                    entry['buckets'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    """
+        All the metrics, in the Prometheus text format
+    """
+    def render(self):
+
+        lines = []
+        with self.lock:
+            for name, values in self.counters.items():
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, self.help[name]))
+                lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+                for key, value in values.items():
+                    lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(dict(key)), value))
+            
+            for name, values in self.histograms.items():
+                lines.append('# HELP {}{} {}'.format(PREFIX, name, self.help[name]))
+                lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+                for key, entry in values.items():
+                    labels = dict(key)
+                    for bound, count in zip(self.buckets[name], entry['buckets']):
+                        labels['le'] = bound
+                        lines.append('{}{}_bucket{} {}'.format(PREFIX, name, format_labels(labels), count))
+                    labels['le'] = '+Inf'
+                    lines.append('{}{}_bucket{} {}'.format(PREFIX, name, format_labels(labels), entry['count']))
+                    lines.append('{}{}_sum{} {}'.format(PREFIX, name, format_labels(dict(key)), entry['sum']))
+                    lines.append('{}{}_count{} {}'.format(PREFIX, name, format_labels(dict(key)), entry['count']))
+
+        for name, callback in self.gauges.items():
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, self.help[name]))
+            lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+            values = callback()
+            if not isinstance(values, list):
+                values = [({}, values)]
+            for labels, value in values:
+                lines.append('{}{}{} {}'.format(PREFIX, name, format_labels(labels), value))
+
+        return('\n'.join(lines) + '\n')
+
+    """
+        Answers a HTTP request : GET /metrics only
+    """
+    async def _handle(self, reader, writer):
+
+        try:
+            request = await reader.readline()
+            # headers are read and ignored
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            fields = request.decode('latin-1').split()
+            if len(fields) >= 2 and fields[0] == 'GET' and fields[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = self.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'Not found\n'
+            writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(status, len(body)).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    """
+        Starts the HTTP endpoint on the asyncio loop (port 0 disables it)
+    """
+    async def serve(self, address, port):
+
+        if port == 0 or self.server != None:
+            return
+        self.server = await asyncio.start_server(self._handle, address, port)
+
+metrics = Metrics()
+
+# pxgrid
+metrics.counter('pxgrid_messages_total', 'pxgrid messages received.')
+metrics.counter('pxgrid_ips_total', '@IPs received in pxgrid sessions with a SGT.')
+metrics.counter('pxgrid_reconnects_total', 'pxgrid websocket reconnections.')
+metrics.counter('pxgrid_control_calls_total', 'pxgrid control calls, by ISE host and result (ok / error).')
+metrics.counter('pxgrid_decode_errors_total', 'pxgrid messages skipped, malformed STOMP frame or JSON.')
+metrics.counter('pxgrid_filtered_total', 'pxgrid messages without any wanted session (fast path filter).')
+metrics.counter('pxgrid_scan_rejected_total', 'pxgrid messages rejected by the filter before decoding.')
+# SMC
+metrics.counter('smc_calls_total', 'SMC API calls, by tenant, verb and HTTP status.')
+metrics.histogram('smc_call_seconds', 'SMC API call latency, by tenant and verb.')
+metrics.histogram('smc_push_seconds', 'Latency of the @IP changes, from the pending queue to the SMC update, by tenant.')
+metrics.counter('smc_rate_limited_total', 'SMC API calls delayed by the rate limiter, by tenant.')
+metrics.counter('tag_creations_total', 'Tags (host groups) created in SMC, by tenant.')
+metrics.counter('smc_errors_total', 'SMC calls failed with an exception, by tenant and stage (pending / batch).')
+metrics.counter('batch_flushes_total', 'Batches of tag updates pushed to SMC, by tenant.')
+metrics.counter('pending_dropped_total', 'Records dropped from the full pending queue, by tenant.')
+metrics.counter('pending_flaps_total', 'SGT changes of an @IP within the settle window, by tenant.')
+metrics.counter('tenant_unrouted_total', '@IPs matching no SMC_TENANTS entry.')
+# cache
+metrics.counter('cache_lookups_total', 'IpCache lookups, by tenant and result (hit / miss).')
+metrics.counter('cache_stale_evictions_total', 'Stale @IPs removed from the cache, by tenant.')
@@ -28,36 +28,184 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import asyncio
 import base64
+import codecs
+import http.client
 import json
-import urllib.request
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+from websockets import ConnectionClosed
+from ws_stomp import WebSocketStomp
+
+from sgTpushed2SWE_log import log
+from sgTpushed2SWE_metrics import metrics
+
+# SGT name of a session in a raw pxgrid message
+SGT_FIELD = re.compile(rb'"ctsSecurityGroup"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+class PxgridHost:
+    """
+    Health of an ISE (pxgrid controller) host: consecutive failures,
+    and time before which it isn't tried again (backoff)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.down_until = 0
+
+    def healthy(self, now):
+        return self.down_until <= now
 
 
 class PxgridControl:
+    """
+    pxgrid control client: calls are spread (round robin) over the
+    healthy ISE_HOST entries, with persistent TLS connections sharing
+    one SSL context. A failed host is skipped for a backoff delay
+    (jittered, doubled on each failure up to PXGRID_BACKOFF_MAX) and
+    the call is retried on the next host, up to PXGRID_RETRIES rounds.
+    Calls come from several threads (startup, reconnections, bulk sync):
+    the pooled connections and the hosts state are used under a lock.
+    The getSessions stream has its own connection, never pooled.
+    """
     def __init__(self, config):
         self.config = config
+        self.hosts = [PxgridHost(host) for host in self.config.ise_host()]
+        self.next = 0
+        self.connections = {}
+        self.lock = threading.RLock()
 
-    def send_rest_request(self, url_suffix, payload):
-        url = 'https://' + \
-            self.config.ise_host()[0] + \
-            ':8910/pxgrid/control/' + url_suffix
-        print("pxgrid url=" + url)
+    def backoff(self, failures):
+        delay = min(self.config.pxgrid_backoff_max(),
+                    self.config.pxgrid_backoff() * 2 ** (failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    # healthy hosts first (round robin), then the others by end of backoff
+    def host_order(self):
+        now = time.time()
+        count = len(self.hosts)
+        hosts = [self.hosts[(self.next + index) % count] for index in range(count)]
+        self.next = (self.next + 1) % count
+        healthy = [host for host in hosts if host.healthy(now)]
+        others = sorted((host for host in hosts if not host.healthy(now)),
+                        key=lambda host: host.down_until)
+        return healthy + others
+
+    def host_failed(self, host, error):
+        host.failures += 1
+        metrics.inc('pxgrid_control_calls_total', { 'host' : host.name, 'result' : 'error' })
+        delay = self.backoff(host.failures)
+        host.down_until = time.time() + delay
+        log.warning('pxgrid', '  ## pxgrid host {} failed ({}), retried in {:.1f}s', host.name, error, delay)
+
+    def connection(self, host, port):
+        key = (host, port)
+        if key not in self.connections:
+            self.connections[key] = http.client.HTTPSConnection(
+                host, port, timeout=self.config.pxgrid_timeout(),
+                context=self.config.get_ssl_context())
+        return self.connections[key]
+
+    def close_connection(self, host, port):
+        connection = self.connections.pop((host, port), None)
+        if connection is not None:
+            connection.close()
+
+    # host, port, path, body and headers of a POST request
+    def request_parts(self, url, payload, password):
         json_string = json.dumps(payload)
-        print('  request=' + json_string)
-        handler = urllib.request.HTTPSHandler(
-            context=self.config.get_ssl_context())
-        opener = urllib.request.build_opener(handler)
-        rest_request = urllib.request.Request(
-            url=url, data=str.encode(json_string))
-        rest_request.add_header('Content-Type', 'application/json')
-        rest_request.add_header('Accept', 'application/json')
+        log.debug('pxgrid', '  request={}', json_string)
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or 443
+        path = parts.path + ('?' + parts.query if parts.query else '')
         b64 = base64.b64encode((self.config.ise_nodename() +
-        ':' + self.config.ise_password()).encode()).decode()
-        rest_request.add_header('Authorization', 'Basic ' + b64)
-        rest_response = opener.open(rest_request)
-        response = rest_response.read().decode()
-        print('  response=' + response)
-        return json.loads(response)
+        ':' + password).encode()).decode()
+        headers = {'Content-Type': 'application/json',
+                   'Accept': 'application/json',
+                   'Authorization': 'Basic ' + b64}
+        return parts.hostname, port, path, json_string.encode(), headers
+
+    # returns the response (to be read completely before the next call
+    # on the same host), raises HTTPError on a HTTP error status
+    # (pooled connection: to be called with the lock held)
+    def open_rest_request(self, url, payload, password):
+        hostname, port, path, body, headers = self.request_parts(url, payload, password)
+        while True:
+            reused = (hostname, port) in self.connections
+            connection = self.connection(hostname, port)
+            try:
+                connection.request('POST', path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                self.close_connection(hostname, port)
+                if reused:
+                    continue  # keep-alive connection closed by the server
+                raise
+            if response.status >= 400:
+                response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            if response.will_close:
+                self.connections.pop((hostname, port), None)
+            return response
+
+    # same as open_rest_request on a new connection, not pooled (for a
+    # response streamed while other calls are made), returns (connection, response)
+    def open_stream_request(self, url, payload, password):
+        hostname, port, path, body, headers = self.request_parts(url, payload, password)
+        connection = http.client.HTTPSConnection(
+            hostname, port, timeout=self.config.pxgrid_timeout(),
+            context=self.config.get_ssl_context())
+        try:
+            connection.request('POST', path, body=body, headers=headers)
+            response = connection.getresponse()
+            if response.status >= 400:
+                response.read()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        except Exception:
+            connection.close()
+            raise
+        return connection, response
+
+    def send_rest_request(self, url_suffix, payload):
+        error = None
+        for attempt in range(self.config.pxgrid_retries()):
+            with self.lock:
+                hosts = self.host_order()
+            for host in hosts:
+                url = 'https://' + host.name + ':8910/pxgrid/control/' + url_suffix
+                log.debug('pxgrid', 'pxgrid url={}', url)
+                with self.lock:
+                    try:
+                        rest_response = self.open_rest_request(url, payload, self.config.ise_password())
+                        response = rest_response.read().decode()
+                    except urllib.error.HTTPError as e:
+                        if e.code < 500:
+                            raise
+                        error = e
+                        self.host_failed(host, e)
+                        continue
+                    except (http.client.HTTPException, OSError) as e:
+                        error = e
+                        self.close_connection(host.name, 8910)
+                        self.host_failed(host, e)
+                        continue
+                    host.failures = 0
+                    host.down_until = 0
+                metrics.inc('pxgrid_control_calls_total', { 'host' : host.name, 'result' : 'ok' })
+                log.debug('pxgrid', '  response={}', response)
+                return json.loads(response)
+            # all the hosts failed, wait for the first one back
+            with self.lock:
+                delay = min(host.down_until for host in self.hosts) - time.time()
+            if attempt + 1 < self.config.pxgrid_retries() and delay > 0:
+                time.sleep(delay)
+        raise ConnectionError('pxgrid control call {} failed on all hosts: {}'.format(url_suffix, error))
 
     def account_activate(self):
         payload = {}
@@ -76,3 +224,246 @@ class PxgridControl:
     def get_access_secret(self, peer_node_name):
         payload = {'peerNodeName': peer_node_name}
         return self.send_rest_request('AccessSecret', payload)
+
+    # streams the sessions known by the session service (getSessions),
+    # without loading the whole response in memory, on its own connection
+    # (drained and closed at the end)
+    # (decoder: JSONDecoder used for the sessions, e.g. SessionFilter.decoder)
+    def get_sessions(self, service, decoder=None):
+        secret = self.get_access_secret(service['nodeName'])['secret']
+        url = service['properties']['restBaseUrl'] + '/getSessions'
+        log.debug('pxgrid', 'pxgrid url={}', url)
+        connection, rest_response = self.open_stream_request(url, {}, secret)
+        try:
+            for session in JsonArrayStream(rest_response, 'sessions', decoder=decoder):
+                yield session
+            rest_response.read()  # end of the document
+        finally:
+            connection.close()
+
+
+class PxgridSubscription:
+    """
+    Subscription to a pxgrid topic, read like a WebSocketStomp.
+    connect() looks up the pubsub service nodes, fetches the AccessSecret
+    and connects the websocket (STOMP CONNECT / SUBSCRIBE) to the first
+    node available; a full round failing is retried after a jittered
+    exponential backoff. When the websocket closes, stomp_read_message()
+    reconnects in place (first attempt immediately) and keeps reading.
+    Blocking control calls are run in the default executor.
+    """
+    def __init__(self, config, pxgrid, pubsub_service_name, topic):
+        self.config = config
+        self.pxgrid = pxgrid
+        self.pubsub_service_name = pubsub_service_name
+        self.topic = topic
+        self.ws = None
+        self.node = 0
+        self.capture_file = None
+
+    async def connect_node(self, service):
+        loop = asyncio.get_event_loop()
+        node_name = service['nodeName']
+        secret = (await loop.run_in_executor(None, self.pxgrid.get_access_secret, node_name))['secret']
+        ws = WebSocketStomp(service['properties']['wsUrl'], self.config.ise_nodename(),
+                            secret, self.config.get_ssl_context())
+        await ws.connect()
+        await ws.stomp_connect(node_name)
+        await ws.stomp_subscribe(self.topic)
+        return ws
+
+    async def connect(self):
+        loop = asyncio.get_event_loop()
+        failures = 0
+        while True:
+            try:
+                lookup = await loop.run_in_executor(None, self.pxgrid.service_lookup, self.pubsub_service_name)
+                services = lookup['services']
+            except Exception as e:
+                log.warning('pxgrid', '  ## pxgrid pubsub service lookup failed ({})', e)
+                services = []
+            for index in range(len(services)):
+                # starts with the node following the last one used
+                service = services[(self.node + index) % len(services)]
+                try:
+                    ws = await self.connect_node(service)
+                except Exception as e:
+                    log.warning('pxgrid', '  ## pxgrid pubsub node {} failed ({})', service.get('nodeName'), e)
+                    continue
+                self.node = (self.node + index) % len(services)
+                if self.ws is not None:
+                    # capture file kept across reconnections
+                    ws.capture, self.ws.capture = self.ws.capture, None
+                elif self.capture_file is not None:
+                    ws.start_capture(self.capture_file)
+                self.ws = ws
+                return
+            failures += 1
+            self.node += 1
+            delay = self.pxgrid.backoff(failures)
+            log.warning('pxgrid', '  ## pxgrid pubsub not available, retried in {:.1f}s', delay)
+            await asyncio.sleep(delay)
+
+    async def stomp_read_message(self):
+        while True:
+            try:
+                return await self.ws.stomp_read_message()
+            except ConnectionClosed:
+                log.warning('pxgrid', 'Websocket connection closed, reconnecting.')
+            metrics.inc('pxgrid_reconnects_total')
+            start = time.time()
+            await self.connect()
+            log.warning('pxgrid', 'Websocket reconnected in {:.2f}s.', time.time() - start)
+
+    def start_capture(self, filename):
+        self.capture_file = filename
+
+    def stop_capture(self):
+        if self.ws is not None:
+            self.ws.stop_capture()
+
+
+class JsonArrayStream:
+    """
+    Iterates over the items of an array in a JSON document read by chunks,
+    ex: {"sessions": [ {...}, {...} ]} ; only one item is decoded at a time.
+    """
+    def __init__(self, stream, key, chunk_size=65536, decoder=None):
+        self.stream = stream
+        self.key = key
+        self.chunk_size = chunk_size
+        self.decoder = decoder or json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buffer += self.utf8.decode(b'', final=True)
+            return False
+        # drop the part already decoded
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(chunk)
+        self.pos = 0
+        return True
+
+    def skip_blanks(self, extra=''):
+        while True:
+            while self.pos < len(self.buffer) and \
+                    (self.buffer[self.pos].isspace() or self.buffer[self.pos] in extra):
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.read_more():
+                return
+
+    def find_array(self):
+        marker = '"' + self.key + '"'
+        while True:
+            index = self.buffer.find(marker, self.pos)
+            if index >= 0:
+                start = self.buffer.find('[', index + len(marker))
+                if start >= 0:
+                    self.pos = start + 1
+                    return True
+            if not self.read_more():
+                return False
+
+    def __iter__(self):
+        if not self.find_array():
+            return
+        while True:
+            self.skip_blanks(',')
+            if self.pos >= len(self.buffer) or self.buffer[self.pos] == ']':
+                return
+            try:
+                item, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # item split over several chunks
+                if not self.read_more():
+                    raise
+                continue
+            self.pos = end
+            yield item
+
+
+class SessionRecord:
+    """
+    Compact record of a pxgrid session: SGT name and @IPs
+    """
+    __slots__ = ('sgt', 'ips')
+
+    def __init__(self, sgt, ips):
+        self.sgt = sgt
+        self.ips = ips
+
+
+class SessionFilter:
+    """
+    Fast path filter of the pxgrid session messages.
+
+    scan() rejects a raw message (bytes) before decoding, when one of the
+    required fields is missing or when none of its SGTs is wanted
+    (PXGRID_SGT_ALLOW / PXGRID_SGT_DENY lists).
+    decode() turns the messages passing the scan into SessionRecords:
+    the decoder keeps only the SGT and @IPs of the sessions, other
+    objects are dropped while decoding (no nested dicts are built),
+    sessions not wanted are filtered out.
+    """
+    def __init__(self, config):
+        self.allow = set(config.pxgrid_sgt_allow())
+        self.deny = set(config.pxgrid_sgt_deny())
+        self.required = set(config.pxgrid_required_fields()) | {'ctsSecurityGroup', 'ipAddresses'}
+        self.markers = [('"' + field + '"').encode('utf-8') for field in self.required]
+        self.decoder = json.JSONDecoder(object_pairs_hook=self.record)
+
+    def sgt_wanted(self, sgt):
+        if len(self.allow) > 0 and sgt not in self.allow:
+            return False
+        return sgt not in self.deny
+
+    def scan(self, payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        for marker in self.markers:
+            if marker not in payload:
+                return False
+        if len(self.allow) == 0 and len(self.deny) == 0:
+            return True
+        for sgt in SGT_FIELD.findall(payload):
+            sgt = json.loads(b'"' + sgt + b'"') if b'\\' in sgt else sgt.decode('utf-8')
+            if self.sgt_wanted(sgt):
+                return True
+        return False
+
+    # object_pairs_hook: SessionRecord for a wanted session, None for other objects
+    def record(self, pairs):
+        sgt = None
+        ips = None
+        found = 0
+        for key, value in pairs:
+            if key == 'sessions':
+                return [session for session in value if session is not None]
+            if key == 'ctsSecurityGroup':
+                sgt = value
+            elif key == 'ipAddresses':
+                ips = value
+            if key in self.required:
+                found += 1
+        if found < len(self.required) or not isinstance(sgt, str) or ips is None or not self.sgt_wanted(sgt):
+            return None
+        return SessionRecord(sgt, [ip for ip in ips if ip != ''])
+
+    # returns the wanted sessions of a raw message, as SessionRecords
+    def decode(self, payload):
+        if not self.scan(payload):
+            metrics.inc('pxgrid_scan_rejected_total')
+            return []
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        sessions = self.decoder.decode(payload)
+        if not isinstance(sessions, list):
+            return []
+        return sessions
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+This script provides the replay of captured pxgrid traffic for sgTpushed2SWE.py.
+
+A capture file (--capture option) holds the raw STOMP MESSAGE payloads
+received from ISE, with their timestamp, as gzip JSON lines.
+The replay (--replay option) feeds them into the subscribe loop in
+place of the pxgrid websocket, without ISE, at the captured pace
+(--replay_speed 1), N times faster (--replay_speed N) or as fast as
+possible (--replay_speed 0).
+ -
+
+"""
+
+__author__      = "Jean-Francois Pujol, Cisco Switzerland"
+__copyright__   = "MIT License. Copyright (c) 2020 Cisco and/or its affiliates."
+__version__     = 1.0
+
+"""
+Copyright (c) 2019, Cisco Systems, Inc. All rights reserved.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import asyncio
+import gzip
+import json
+import time
+
+from sgTpushed2SWE_log import log
+
+"""
+    Reads the records of a capture file : [ (time, message), ... ]
+    A truncated end of file (capture interrupted) is ignored.
+"""
+def read_capture(filename):
+
+    records = []
+    try:
+        with gzip.open(filename, 'rt', encoding='utf-8') as capture:
+            for line in capture:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                records.append((record['time'], record['message']))
+    except EOFError:
+        pass
+    return(records)
+
+"""
+    Returns the percentile of a sorted list of values
+"""
+def percentile(values, rank):
+
+    if len(values) == 0:
+        return(0.0)
+    index = min(len(values) - 1, int(len(values) * rank / 100))
+    return(values[index])
+
+"""
+    ---------------------------------------------------------------------------------
+
+    ReplayStomp Class : replays a capture file in place of WebSocketStomp
+
+    Same interface as WebSocketStomp for the subscribe loop :
+     - connect() does nothing
+     - stomp_read_message() returns the next captured message when it is
+       due (captured delay / speed, no delay with speed 0), and raises
+       EOFError at the end of the capture.
+    
+    Lag : delay between the due time of a message and its delivery
+    (reader too slow to keep the pace). The reader doesn't wait for SMC :
+    the processing time is measured up to the end of the last SMC update
+    (end given to report()). Per event latency : from the enqueue of a
+    record to the SMC update carrying its change (TagBatcher latencies).
+     - report(smcCalls, end, latencies) logs the throughput, latencies and lag
+
+    ---------------------------------------------------------------------------------
+"""
+class ReplayStomp:
+    def __init__(self, filename, speed = 1.0):
+        self.filename = filename
+        self.speed = speed
+        self.records = read_capture(filename)
+        self.index = 0
+        self.start = None
+        self.lags = []
+        self.end = None
+
+    async def connect(self):
+        log.info('replay', "* Replay of {} : {} messages, speed {}.", self.filename, len(self.records), self.speed if self.speed > 0 else 'max')
+
+    async def stomp_read_message(self):
+
+        now = time.time()
+        if self.index >= len(self.records):
+            if self.end == None:
+                self.end = now
+            raise EOFError('end of replay')
+        
+        if self.start == None:
+            self.start = now
+        tick, message = self.records[self.index]
+        self.index += 1
+        
+        if self.speed > 0:
+            due = self.start + (tick - self.records[0][0]) / self.speed
+            if due > now:
+                await asyncio.sleep(due - now)
+            elif due < now:
+                self.lags.append(now - due)
+        
+        return(message)
+
+    async def disconnect(self):
+        pass
+
+    """
+        Logs the replay results : throughput (up to end, the time the last
+        changes were pushed to SMC ; default the end of the capture),
+        latencies of the changes pushed to SMC, lag and SMC API calls
+    """
+    def report(self, smcCalls, end = None, latencies = ()):
+
+        if self.start == None:
+            log.info('replay', "* Replay : no message.")
+            return
+        duration = max((end or self.end or time.time()) - self.start, 0.000001)
+        readTime = max((self.end or time.time()) - self.start, 0.000001)
+        lags = sorted(self.lags)
+        log.info('replay', "* Replay : {} messages read in {:.2f}s ({:.1f} msg/s), pushed to SMC in {:.2f}s ({:.1f} msg/s), {} SMC API calls ({:.1f}/s).",
+            self.index, readTime, self.index / readTime, duration, self.index / duration, smcCalls, smcCalls / duration)
+        latencies = sorted(latencies)
+        log.info('replay', "  latency to SMC (ms) : {} changes pushed, p50 {:.2f}, p95 {:.2f}, p99 {:.2f}, max {:.2f}.",
+            len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000, (latencies[-1] if latencies else 0.0) * 1000)
+        if self.speed > 0:
+            log.info('replay', "  lag behind the capture pace (ms) : {} late messages, p95 {:.2f}, max {:.2f}.",
+                len(lags), percentile(lags, 95) * 1000, (lags[-1] if lags else 0.0) * 1000)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""
+This script provides a SMC simulator, to load test sgTpushed2SWE.py
+without a Stealthwatch appliance.
+
+It implements the SMC API endpoints used by the agent (authentication,
+tenants, tags GET/POST/PUT), over http, with a configurable latency,
+error injection and rate limit (429 above the limit).
+It can be started from the cli, or in process (benchmark) :
+
+  python sgTpushed2SWE_smcsim.py --port 8080 --latency 0.05 --error 429:0.01 --max_rate 20
+
+The agent is pointed to it with SMC_HOST = "127.0.0.1:8080" and
+SMC_PROTOCOL = "http".
+ -
+
+"""
+
+__author__      = "Jean-Francois Pujol, Cisco Switzerland"
+__copyright__   = "MIT License. Copyright (c) 2020 Cisco and/or its affiliates."
+__version__     = 1.0
+
+"""
+Copyright (c) 2019, Cisco Systems, Inc. All rights reserved.
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import argparse
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+
+TAGS_PATH = re.compile(r'^/smc-configuration/rest/v1/tenants/(\d+)/tags/?(\d+)?$')
+
+"""
+    ---------------------------------------------------------------------------------
+
+    SmcSimulator Class : SMC API simulator
+
+     - latency / jitter : delay added to each call (seconds)
+     - errors : { HTTP code : probability }, e.g. { 429 : 0.01, 503 : 0.001 }
+     - max_rate : calls per second above which 429 is returned (0 = no limit)
+     - rootTags : tag/group names existing at startup (SGT parent groups)
+     - tenants : number of tenants (domains), IDs 101, 102, ... named
+       simulator-1, simulator-2, ... each one with its own tags
+     - start() serves the API in a background thread, stop() ends it
+     - stats() returns the number of calls, per verb and per status,
+       and the number of ranges in the tags
+
+    ---------------------------------------------------------------------------------
+"""
+class SmcSimulator:
+    def __init__(self, latency = 0.0, jitter = 0.0, errors = None, max_rate = 0, rootTags = ('TAGS',), tenants = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors or {}
+        self.max_rate = max_rate
+        self.tenantIds = [101 + index for index in range(tenants)]
+        self.lock = threading.Lock()
+        self.tags = { tenantId : {} for tenantId in self.tenantIds } # per tenant
+        self.nextId = 1000
+        self.calls = {}
+        self.statuses = {}
+        self.window = (0, 0) # (second, number of calls)
+        self.server = None
+        self.thread = None
+        for tenantId in self.tenantIds:
+            for tagName in rootTags:
+                self._createTag(tenantId, { 'name' : tagName, 'parentId' : 0, 'ranges' : [] })
+
+    def _createTag(self, tenantId, tag):
+        tag = dict(tag)
+        tag['id'] = self.nextId
+        self.nextId += 1
+        self.tags[tenantId][tag['id']] = tag
+        return(tag)
+
+    """
+        Rate limit : returns False if the call exceeds max_rate
+    """
+    def _allowed(self):
+
+        if self.max_rate == 0:
+            return(True)
+        now = int(time.time())
+        second, count = self.window
+        if second != now:
+            second, count = now, 0
+        self.window = (second, count + 1)
+        return(count < self.max_rate)
+
+    """
+        Processes an API call, returns (status, response body)
+    """
+    def handle(self, verb, path, body):
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        with self.lock:
+            status, response = self._route(verb, path, body)
+            self.calls[verb] = self.calls.get(verb, 0) + 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return(status, response)
+
+    def _route(self, verb, path, body):
+
+        if not self._allowed():
+            return(429, { 'error' : 'Too many requests' })
+        for code, probability in self.errors.items():
+            if random.random() < probability:
+                return(code, { 'error' : 'Injected error' })
+
+        if verb == 'POST' and path == '/token/v2/authenticate':
+            return(200, {})
+        if verb == 'DELETE' and path == '/token':
+            return(200, {})
+        if verb == 'GET' and path.rstrip('/') == '/sw-reporting/v1/tenants':
+            return(200, { 'data' : [ { 'id' : tenantId, 'displayName' : 'simulator-{}'.format(index + 1) } for index, tenantId in enumerate(self.tenantIds) ] })
+
+        match = TAGS_PATH.match(path)
+        if match == None or int(match.group(1)) not in self.tags:
+            return(404, { 'error' : 'Not found' })
+        tenantId = int(match.group(1))
+        tags = self.tags[tenantId]
+        tagId = match.group(2)
+
+        if tagId == None:
+            if verb == 'GET':
+                return(200, { 'data' : [ { 'id' : tag['id'], 'name' : tag['name'], 'parentId' : tag['parentId'] } for tag in tags.values() ] })
+            if verb == 'POST':
+                return(200, { 'data' : [ self._createTag(tenantId, tag) for tag in body ] })
+            return(405, { 'error' : 'Method not allowed' })
+
+        tagId = int(tagId)
+        if tagId not in tags:
+            return(404, { 'error' : 'Not found' })
+        if verb == 'GET':
+            return(200, { 'data' : tags[tagId] })
+        if verb == 'PUT':
+            tag = dict(body)
+            tag['id'] = tagId
+            tags[tagId] = tag
+            return(200, { 'data' : tag })
+        return(405, { 'error' : 'Method not allowed' })
+
+    def stats(self):
+        with self.lock:
+            return({ 'calls' : sum(self.calls.values()), 'verbs' : dict(self.calls), 'statuses' : dict(self.statuses),
+                'ranges' : sum(len(tag.get('ranges', [])) for tags in self.tags.values() for tag in tags.values()) })
+
+    """
+        Serves the API on address:port (port 0 = any free port),
+        returns the port used
+    """
+    def start(self, address = '127.0.0.1', port = 0):
+
+        self.server = SimHTTPServer((address, port), SimRequestHandler)
+        self.server.sim = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='smc-simulator', daemon=True)
+        self.thread.start()
+        return(self.server.server_address[1])
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class SimHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class SimRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _serve(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = None
+        if length > 0:
+            data = self.rfile.read(length)
+            try:
+                body = json.loads(data.decode('utf-8'))
+            except ValueError:
+                body = None
+        status, response = self.server.sim.handle(self.command, self.path, body)
+        content = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _serve
+    do_POST = _serve
+    do_PUT = _serve
+    do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        pass
+
+"""
+    Parses the --error options : [ 'code:probability', ... ]
+"""
+def parse_errors(errors):
+
+    injected = {}
+    for error in errors or []:
+        code, probability = error.split(':', 1)
+        injected[int(code)] = float(probability)
+    return(injected)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='SMC API simulator')
+    parser.add_argument('--address', default='127.0.0.1', help='listening address')
+    parser.add_argument('--port', type=int, default=8080, help='listening port')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay added to each call (seconds)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random delay added to the latency (seconds)')
+    parser.add_argument('--error', action='append', help='injected error, code:probability (e.g. 503:0.01), repeatable')
+    parser.add_argument('--max_rate', type=int, default=0, help='calls per second above which 429 is returned, 0 = no limit')
+    parser.add_argument('--tag', action='append', help='tag/group existing at startup (default TAGS), repeatable')
+    parser.add_argument('--tenants', type=int, default=1, help='number of tenants (domains)')
+    args = parser.parse_args()
+
+    sim = SmcSimulator(args.latency, args.jitter, parse_errors(args.error), args.max_rate, args.tag or ('TAGS',), args.tenants)
+    port = sim.start(args.address, args.port)
+    print("SMC simulator listening on {}:{} (tenants {}).".format(args.address, port, sim.tenantIds), flush=True)
+    try:
+        while True:
+            time.sleep(60)
+            print("* {}".format(sim.stats()), flush=True)
+    except KeyboardInterrupt:
+        sim.stop()
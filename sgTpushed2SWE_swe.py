@@ -46,8 +46,319 @@ try:
     requests.packages.urllib3.disable_warnings()
 except:
     pass
+import asyncio
+import concurrent.futures
+import functools
+import heapq
+import ipaddress
 import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
 import time
+from collections import OrderedDict
+
+from sgTpushed2SWE_log import log, INFO
+from sgTpushed2SWE_metrics import metrics
+
+"""
+    ---------------------------------------------------------------------------------
+    SMC tag/group ranges helpers
+    
+    A range entry is a single @IP, a CIDR block or a 'first-last' range.
+    Entries other than single @IPs are handled as lists of networks.
+    
+    ---------------------------------------------------------------------------------
+"""
+
+# max number of @IPs expanded from a CIDR/range entry
+MAX_RANGE_EXPAND = 65536
+
+"""
+    Returns True if the range entry is a single @IP
+"""
+def is_single_ip(entry):
+    return('/' not in entry and '-' not in entry)
+
+"""
+    Returns the networks covered by a range entry, [] if not understood
+"""
+def parse_range(entry):
+    try:
+        if '-' in entry:
+            first, last = entry.split('-', 1)
+            return(list(ipaddress.summarize_address_range(ipaddress.ip_address(first.strip()), ipaddress.ip_address(last.strip()))))
+        return([ipaddress.ip_network(entry.strip(), strict=False)])
+    except (ValueError, TypeError):
+        return([])
+
+"""
+    Returns the range entries (strings) for a list of networks ;
+    host networks are written as single @IPs.
+"""
+def format_networks(networks):
+    return([str(network.network_address) if network.num_addresses == 1 else str(network) for network in networks])
+
+"""
+    Returns the @IPs covered by the range entries (CIDR/range entries
+    larger than MAX_RANGE_EXPAND are ignored)
+"""
+def expand_ranges(ranges):
+    IpAddresses = set()
+    for entry in ranges:
+        if is_single_ip(entry):
+            IpAddresses.add(entry)
+            continue
+        for network in parse_range(entry):
+            if network.num_addresses <= MAX_RANGE_EXPAND:
+                IpAddresses.update(str(IpAddr) for IpAddr in network)
+    return(IpAddresses)
+
+"""
+    Collapses range entries into the smallest list of CIDR blocks
+    (entries not understood are kept as they are)
+"""
+def compact_ranges(ranges):
+    networks = { 4 : [], 6 : [] }
+    others = []
+    for entry in ranges:
+        parsed = parse_range(entry)
+        if len(parsed) == 0:
+            others.append(entry)
+        for network in parsed:
+            networks[network.version].append(network)
+    compacted = []
+    for version in (4, 6):
+        compacted.extend(format_networks(ipaddress.collapse_addresses(networks[version])))
+    return(compacted + others)
+
+"""
+    Checks if a network covers another one (same as subnet_of, which
+    only exists from python 3.7)
+"""
+def network_covers(network, IpNet):
+    return(IpNet.version == network.version and
+        network.network_address <= IpNet.network_address and IpNet.broadcast_address <= network.broadcast_address)
+
+"""
+    Removes @IPs from range entries ; CIDR/range entries covering
+    one of the @IPs are split.
+"""
+def remove_from_ranges(ranges, delIPs):
+    delIPs = set(delIPs)
+    if len(delIPs) == 0:
+        return(list(ranges))
+    delAddresses = []
+    for IpAddr in delIPs:
+        try:
+            delAddresses.append(ipaddress.ip_network(IpAddr))
+        except ValueError:
+            pass
+    result = []
+    for entry in ranges:
+        if entry in delIPs:
+            continue
+        if is_single_ip(entry):
+            result.append(entry)
+            continue
+        networks = parse_range(entry)
+        covered = [IpNet for IpNet in delAddresses if any(network_covers(network, IpNet) for network in networks)]
+        if len(networks) == 0 or len(covered) == 0:
+            result.append(entry)
+            continue
+        for IpNet in covered:
+            remaining = []
+            for network in networks:
+                if network_covers(network, IpNet):
+                    remaining.extend(network.address_exclude(IpNet))
+                else:
+                    remaining.append(network)
+            networks = remaining
+        result.extend(format_networks(ipaddress.collapse_addresses(networks)))
+    return(result)
+
+"""
+    ---------------------------------------------------------------------------------
+
+    IpPrefixIndex Class : prefix index of the tags/groups ranges (IPv4 & IPv6)
+
+    Prefix trie stored as one hash table per prefix length (and family) ;
+    a lookup walks the prefix lengths in use, from the longest one, so
+    it costs at most one hash lookup per prefix length.
+    Format : { version : { prefixlen : { prefix (int) : { tagId : count } } } }
+    Several entries of a tag may give the same prefix (10.0.0.0/24 and
+    10.0.0.0-10.0.0.255) : each tagId is counted, and removed from a
+    prefix with its last entry.
+     - add() / remove() a range entry (@IP, CIDR, first-last) for a tagId
+     - covering() reports all the tagIds covering an @IP
+     - lookup() reports the tagIds of the most specific entry
+
+    ---------------------------------------------------------------------------------
+"""
+class IpPrefixIndex:
+    def __init__(self):
+        self.tables = { 4 : {}, 6 : {} }
+        self.lengths = { 4 : [], 6 : [] } # prefix lengths in use, longest first
+        self.lock = threading.Lock()
+
+    """
+        Returns (version, integer value) of an @IP, None if invalid
+    """
+    @staticmethod
+    def address(IpAddr):
+        try:
+            if ':' in IpAddr:
+                return((6, int.from_bytes(socket.inet_pton(socket.AF_INET6, IpAddr), 'big')))
+            return((4, int.from_bytes(socket.inet_pton(socket.AF_INET, IpAddr), 'big')))
+        except (OSError, ValueError, TypeError):
+            return(None)
+
+    """
+        Returns the (version, prefixlen, prefix) keys of a range entry
+    """
+    @staticmethod
+    def prefixes(entry):
+        if is_single_ip(entry):
+            address = IpPrefixIndex.address(entry)
+            if address == None:
+                return([])
+            version, value = address
+            return([(version, 32 if version == 4 else 128, value)])
+        return([(network.version, network.prefixlen, int(network.network_address) >> (network.max_prefixlen - network.prefixlen))
+                for network in parse_range(entry)])
+
+    def add(self, entry, tagId):
+        with self.lock:
+            for version, prefixlen, prefix in self.prefixes(entry):
+                table = self.tables[version].get(prefixlen)
+                if table == None:
+                    table = self.tables[version][prefixlen] = {}
+                    self.lengths[version] = sorted(self.tables[version].keys(), reverse=True)
+                tagIds = table.setdefault(prefix, {})
+                tagIds[tagId] = tagIds.get(tagId, 0) + 1
+
+    def remove(self, entry, tagId):
+        with self.lock:
+            for version, prefixlen, prefix in self.prefixes(entry):
+                table = self.tables[version].get(prefixlen)
+                if table == None or prefix not in table:
+                    continue
+                tagIds = table[prefix]
+                if tagId not in tagIds:
+                    continue
+                tagIds[tagId] -= 1
+                if tagIds[tagId] > 0:
+                    continue
+                del tagIds[tagId]
+                if len(tagIds) == 0:
+                    del table[prefix]
+                if len(table) == 0:
+                    del self.tables[version][prefixlen]
+                    self.lengths[version] = sorted(self.tables[version].keys(), reverse=True)
+
+    def covering(self, IpAddr, longest = False):
+        address = self.address(IpAddr)
+        if address == None:
+            return(set())
+        version, value = address
+        maxlen = 32 if version == 4 else 128
+        tagIds = set()
+        with self.lock:
+            for prefixlen in self.lengths[version]:
+                table = self.tables[version][prefixlen]
+                prefix = value >> (maxlen - prefixlen)
+                if prefix in table:
+                    tagIds.update(table[prefix])
+                    if longest:
+                        break
+        return(tagIds)
+
+    def lookup(self, IpAddr):
+        return(self.covering(IpAddr, longest = True))
+
+"""
+    ---------------------------------------------------------------------------------
+
+    TagCatalog Class : tags/groups defined in SMC, indexed by name and ID
+
+    Format : { tagId : tag } with name -> tagId and parentId -> [ tagIds ]
+    indexes. A name used by several tags resolves to the first one listed
+    (same as a scan of the tag list).
+    The catalog is updated by the SMC threads and read from the loop,
+    updates and scans are protected by a lock.
+
+    ---------------------------------------------------------------------------------
+"""
+class TagCatalog:
+    def __init__(self):
+        self.byId = {}
+        self.byName = {}
+        self.byParent = {}
+        self.lock = threading.RLock()
+
+    """
+        Rebuilds the catalog from the list of tags returned by SMC
+    """
+    def refresh(self, tag_list):
+        with self.lock:
+            self.byId = {}
+            self.byName = {}
+            self.byParent = {}
+            for tag in tag_list:
+                self.add(tag)
+
+    """
+        Adds (or replaces) a tag in the catalog
+    """
+    def add(self, tag):
+        with self.lock:
+            if tag['id'] in self.byId:
+                self.remove(tag['id'])
+            self.byId[tag['id']] = tag
+            self.byName.setdefault(tag['name'], tag['id'])
+            self.byParent.setdefault(tag.get('parentId'), []).append(tag['id'])
+
+    """
+        Removes a tag from the catalog
+    """
+    def remove(self, tagId):
+        with self.lock:
+            tag = self.byId.pop(tagId, None)
+            if tag == None:
+                return
+            siblings = self.byParent.get(tag.get('parentId'), [])
+            if tagId in siblings:
+                siblings.remove(tagId)
+            if self.byName.get(tag['name']) == tagId:
+                del self.byName[tag['name']]
+                # another tag with the same name, if any
+                for other in self.byId.values():
+                    if other['name'] == tag['name']:
+                        self.byName[tag['name']] = other['id']
+                        break
+
+    def idFromName(self, tagName):
+        return(self.byName.get(tagName, ''))
+
+    def get(self, tagId):
+        return(self.byId.get(tagId))
+
+    def names(self):
+        with self.lock:
+            return(list(self.byName.keys()))
+
+    def children(self, parentId):
+        with self.lock:
+            return([self.byId[tagId] for tagId in self.byParent.get(parentId, [])])
+
+    def list(self):
+        with self.lock:
+            return(list(self.byId.values()))
+
+    def __len__(self):
+        return(len(self.byId))
 
 """
     ---------------------------------------------------------------------------------
@@ -73,16 +384,21 @@ class SmcControl:
             "username": self.config.smc_user(),
             "password": self.config.smc_password()
         }
-        self.tag_list = []
+        self.tags = TagCatalog()
+        self.tag_shadow = {}
+        self.shadow_lock = threading.RLock() # shadow updated by the SMC threads
+        self.ip_index = IpPrefixIndex() # ranges of the shadowed tags
         self.tenantId = 0
+        self.labels = { 'tenant' : self.config.tenant_name() } # metrics labels
         self.apiRate = Speedo()
         self.lastAuth = int(time.time()) - 2 * self.config.smc_reauth()
         self.sgtRootTags = {}
         self.sgtRootName = ''
-        self.auth_url = "https://" + self.config.smc_host() + "/token/v2/authenticate"
-        self.tenant_url = 'https://' + self.config.smc_host() + '/sw-reporting/v1/tenants/'
-        self.close_url = 'https://' + self.config.smc_host() + '/token'
-        self.tag_url = 'https://' + self.config.smc_host() + '/smc-configuration/rest/v1/tenants/'
+        base_url = self.config.smc_protocol() + '://' + self.config.smc_host()
+        self.auth_url = base_url + "/token/v2/authenticate"
+        self.tenant_url = base_url + '/sw-reporting/v1/tenants/'
+        self.close_url = base_url + '/token'
+        self.tag_url = base_url + '/smc-configuration/rest/v1/tenants/'
     
     """
         Authentication process to FMC
@@ -95,92 +411,192 @@ class SmcControl:
             # no need to re-authenticate
             return(True)
         
-        self.apiRate.monitor()
         # after SMC_REAUTH, need to perform the POST request to login
-        response = self.api_session.request("POST", self.auth_url, verify=False, data=self.smc_login)
+        response = self.request("POST", self.auth_url, data=self.smc_login)
         if(response.status_code == 200):
             self.lastAuth = now
             return(True)
         else:
-            print("An error has ocurred, while logging in, with the following code {}".format(response.status_code))
+            log.error('smc', "An error has ocurred, while logging in, with the following code {}", response.status_code)
             return(False)
 
     """
         Look for the tenant ID which is required to retrieve / post other data
+        (tenant given by its ID or name in the config, the first one per default)
     """
     def get_tenantID(self):
     
         # check for authentication
         self.authenticate()
         
-        self.apiRate.monitor()
         # Get the list of tenants (domains) from the SMC
-        response = self.api_session.request("GET", self.tenant_url, verify=False)
+        response = self.request("GET", self.tenant_url)
         if (response.status_code == 200):
-            # Store the tenant (domain) ID
+            # Store the tenant (domain) ID : the configured one (ID or name), or the first one
             tenant_list = json.loads(response.content)["data"]
-            self.tenantId = tenant_list[0]["id"]
-            print("Found SWE tenant ID = {}".format(self.tenantId))
+            tenant = self.config.smc_tenant()
+            for entry in tenant_list:
+                if tenant == '' or tenant in (str(entry["id"]), entry.get("displayName")):
+                    self.tenantId = entry["id"]
+                    log.info('smc', "Found SWE tenant ID = {} ({})", self.tenantId, entry.get("displayName", ''))
+                    return(self.tenantId)
+            print(" !! Config error, >{}< tenant (domain) doesn't exist in SMC".format(tenant))
+            exit(-1)
         else:
-            print("An error has ocurred, while fetching tenants (domains), with the following code {}".format(response.status_code))
+            log.error('smc', "An error has ocurred, while fetching tenants (domains), with the following code {}", response.status_code)
     
     """
         List and store the existing host groups in the tenant.
         Host groups in the API calls library are named "tags"
-        The result is a dictionnary with group/tag names and IDs
+        The result is stored in the tag catalog (names, IDs and parents)
     """
     def tagList(self):
     
         # check for authentication
         self.authenticate()
         
-        self.apiRate.monitor()
         url = self.tag_url + str(self.tenantId) + '/tags/'
-        response = self.api_session.request("GET", url, verify=False)
+        response = self.request("GET", url)
         if (response.status_code == 200):
             # Return the list
             tag_list = json.loads(response.content)["data"]
-            self.tag_list = tag_list
+            self.tags.refresh(tag_list)
         # If unable to fetch list of tags (host groups)
         else:
-            print("An error has ocurred, while fetching tags (host groups), with the following code {}".format(response.status_code))
-            self.tag_list = []
+            log.error('smc', "An error has ocurred, while fetching tags (host groups), with the following code {}", response.status_code)
+            self.tags.refresh([])
             
-        return(self.tag_list)
+        return(self.tags.list())
     
     """
         Retrieve all details for a particular tag (group) ID,
         including all @IPs already bound to it.
+        The details are served from the local shadow of the tag,
+        and fetched from SMC only if unknown, older than
+        SMC_SHADOW_REFRESH or when refresh is requested.
+        The returned details are shared with the shadow: do not modify them.
     """
-    def tag_details(self, tagId):
+    def tag_details(self, tagId, refresh = False):
         
         if tagId == '':
             return(self.config.smc_unknown_tag())
+        
+        shadow = self.tag_shadow.get(tagId)
+        if shadow != None and not refresh and self.shadowed(tagId):
+            return(shadow['body'])
             
         # check for authentication
         self.authenticate()
         
-        self.apiRate.monitor()
         url = self.tag_url + str(self.tenantId) + '/tags/' + str(tagId)
-        response = self.api_session.request("GET", url, verify=False)
+        response = self.request("GET", url)
         if (response.status_code == 200):
-            # Grab the tag details and check if the malicious IP is associated with this tag
-            return(json.loads(response.content)["data"])
+            # Grab the tag details and keep them in the shadow
+            return(self.shadowTag(tagId, json.loads(response.content)["data"]))
         else:
-            print('## Unable to locate tag Id: {}, return code {}.'.format(tagId, response.status_code))
-            if (response.status_code == 404): # not found, refresh the list
-                self.tagList()  
+            log.warning('smc', '## Unable to locate tag Id: {}, return code {}.', tagId, response.status_code)
+            self.dropShadow(tagId)
+            if (response.status_code == 404): # not found, removed from the list
+                self.tags.remove(tagId)
             return(self.config.smc_unknown_tag())
     
+    """
+        Stores the last known details of a tag (group), its ranges
+        are indexed for fast membership checks.
+        A shadow entry is replaced, never modified: readers can use
+        the entry they got without the lock.
+    """
+    def shadowTag(self, tagId, tagDetails):
+        
+        if 'ranges' not in tagDetails:
+            self.dropShadow(tagId)
+            return(tagDetails)
+        ranges = set(tagDetails['ranges'])
+        with self.shadow_lock:
+            oldRanges = set()
+            if tagId in self.tag_shadow:
+                oldRanges = self.tag_shadow[tagId]['ranges']
+            for entry in oldRanges - ranges:
+                self.ip_index.remove(entry, tagId)
+            for entry in ranges - oldRanges:
+                self.ip_index.add(entry, tagId)
+            self.tag_shadow[tagId] = {
+                'body' : tagDetails,
+                'ranges' : ranges,
+                'tick' : int(time.time())
+            }
+        return(tagDetails)
+    
+    """
+        Forgets the details of a tag (group)
+    """
+    def dropShadow(self, tagId):
+        
+        with self.shadow_lock:
+            shadow = self.tag_shadow.pop(tagId, None)
+            if shadow != None:
+                for entry in shadow['ranges']:
+                    self.ip_index.remove(entry, tagId)
+    
+    """
+        Checks if the shadow of a tag (group) is known and recent enough
+    """
+    def shadowed(self, tagId):
+        
+        shadow = self.tag_shadow.get(tagId)
+        if shadow == None:
+            return(False)
+        return(int(time.time()) - shadow['tick'] < self.config.smc_shadow_refresh())
+    
+    """
+        Checks if an @IP is bound to the tag (group), as a single @IP
+        or covered by a CIDR/range entry
+        (from the shadow, SMC is queried only if the tag isn't known)
+    """
+    def tagHasIp(self, tagId, IpAddr):
+        
+        shadow = self.tag_shadow.get(tagId)
+        if shadow == None:
+            if 'ranges' not in self.tag_details(tagId):
+                return(False)
+            shadow = self.tag_shadow.get(tagId)
+            if shadow == None:
+                return(False)
+        if IpAddr in shadow['ranges']:
+            return(True)
+        return(tagId in self.ip_index.covering(IpAddr))
+    
+    """
+        Returns the SGT managed tags (groups) covering an @IP,
+        among the shadowed ones.
+    """
+    def sgtTagsCovering(self, IpAddr):
+        
+        tagIds = self.ip_index.covering(IpAddr)
+        if len(tagIds) == 0:
+            return(tagIds)
+        return(tagIds & set(tag['id'] for tag in self.sgtTags()))
+    
+    """
+        Returns the set of @IPs bound to the tag (group),
+        CIDR/range entries expanded (from the shadow)
+    """
+    def tagMembers(self, tagId):
+        
+        shadow = self.tag_shadow.get(tagId)
+        if shadow == None:
+            tagDetails = self.tag_details(tagId)
+            if 'ranges' not in tagDetails:
+                return(set())
+            return(expand_ranges(tagDetails['ranges']))
+        return(expand_ranges(shadow['body']['ranges']))
+    
     """
         Returns an ID from the tag/group dictionnary.
     """
     def tagIdFromName(self,tagName):
         
-        for tag in self.tag_list:
-            if tag['name'] == tagName:
-                return(tag['id'])
-        return('')
+        return(self.tags.idFromName(tagName))
 
     """
         From the config file, verify the parent groups/tags are valid
@@ -190,8 +606,8 @@ class SmcControl:
         sgtRootName = self.config.smc_sgt_default_parent()
         sgtRootTags = self.config.smc_sgt_parent_tags()
         
-        # list of tag/group names found in SMC
-        tagNames = set(item['name'] for item in self.tag_list)
+        # tag/group names found in SMC
+        tagNames = self.tags.names()
         
         if sgtRootName not in tagNames:
             print(" !! Config error, >{}< group doesn't exist in SMC".format(sgtRootName))
@@ -215,6 +631,19 @@ class SmcControl:
         else:
             return(self.sgtRootName)
     
+    """
+        List the tags/groups managed from SGTs : children of the
+        default parent tag, or of the parent tag configured for their SGT.
+    """
+    def sgtTags(self):
+        
+        sgtTags = { tag['id'] : tag for tag in self.tags.children(self.tags.idFromName(self.sgtRootName)) }
+        for sgtName, tagName in self.sgtRootTags.items():
+            for tag in self.tags.children(self.tags.idFromName(tagName)):
+                if tag['name'] == sgtName:
+                    sgtTags[tag['id']] = tag
+        return(list(sgtTags.values()))
+    
     """
         Creates a new group/tag in SMC
         Baselining for individual @IP is set to off
@@ -245,22 +674,23 @@ class SmcControl:
         ]
 
         # Add the new tag (host group) in the SMC
-        self.apiRate.monitor()
         url = self.tag_url + str(self.tenantId) + '/tags'
         request_headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
-        response = self.api_session.request("POST", url, verify=False, data=json.dumps(request_data), headers=request_headers)
+        response = self.request("POST", url, data=json.dumps(request_data), headers=request_headers)
         # If successfully able to add the tag (host group)
         if (response.status_code != 200):
-            print("## Cannot create tag for :", tagName)
+            log.error('tag', "## Cannot create tag for : {}", tagName)
             # try refreshing the list in case some change was done in SMC
             self.tagList()
             return('')
         
         tagDetails= json.loads(response.content)["data"][0]
         tagId = tagDetails['id']
+        self.shadowTag(tagId, tagDetails)
         
         # update tag list
-        self.tag_list.append({'id' : tagId, 'name' : tagName})
+        self.tags.add({'id' : tagId, 'name' : tagName, 'parentId' : rootTagId})
+        metrics.inc('tag_creations_total', self.labels)
         
         return(tagId)
     
@@ -269,44 +699,82 @@ class SmcControl:
     """
     def addIp2Tag(self,tagId,tagDetails,IpAddr):
     
-        # check for authentication
-        self.authenticate()
-        
-        url = self.tag_url + str(self.tenantId) + '/tags/' + str(tagId)
-        # Modify the details of thee given tag (host group) from the SMC
-        tagDetails['ranges'].append(IpAddr)
-
-        self.apiRate.monitor()
-        # Update the details of the given tag in the SMC
-        request_headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
-        response = self.api_session.request("PUT", url, verify=False, data=json.dumps(tagDetails), headers=request_headers)
-        # If successfully able to update the tag (host group)
-        updatedTagDetails = json.loads(response.content)["data"]
-        if (response.status_code != 200) or IpAddr not in updatedTagDetails["ranges"]:
-            print("Impossible to add Ip addr into tagId {} (code {}):".format(str(tagId),response.status_code))
+        updatedTagDetails = self.updateTag(tagId, tagDetails, [IpAddr], [])
+        if 'ranges' not in updatedTagDetails or not self.tagHasIp(tagId, IpAddr):
+            log.error('smc', "Impossible to add Ip addr into tagId {}.", tagId)
     
     """
         Remove an @IP from the range list in the tag/group
     """
     def delIpFromTag(self,tagId,tagDetails,IpAddr):
     
+        updatedTagDetails = self.updateTag(tagId, tagDetails, [], [IpAddr])
+        if 'ranges' not in updatedTagDetails or self.tagHasIp(tagId, IpAddr):
+            log.error('smc', "Impossible to remove Ip addr from tagId {}.", tagId)
+
+    """
+        Add and remove a list of @IPs in the range list of the tag/group,
+        with a single API call. Returns the updated tag details or
+        the unknown tag value if the update failed.
+        With SMC_CIDR_COMPACT, the ranges are sent as CIDR blocks.
+        On a conflict (409), the tag details are fetched again and
+        the update is retried once.
+    """
+    def updateTag(self,tagId,tagDetails,addIPs,delIPs,retry = True):
+
         # check for authentication
         self.authenticate()
-        
+
         url = self.tag_url + str(self.tenantId) + '/tags/' + str(tagId)
-        # Modify the details of thee given tag (host group) from the SMC
-        
-        if IpAddr in tagDetails['ranges']:
-            tagDetails['ranges'].remove(IpAddr)
-        
-        self.apiRate.monitor()
+        # Build the new details of the given tag (host group),
+        # from the latest details known in the shadow
+        shadow = self.tag_shadow.get(tagId)
+        if shadow != None:
+            tagDetails = shadow['body']
+        ranges = remove_from_ranges(tagDetails['ranges'], delIPs)
+        present = set(ranges)
+        for IpAddr in addIPs:
+            if IpAddr not in present:
+                ranges.append(IpAddr)
+                present.add(IpAddr)
+        if self.config.smc_cidr_compact() == 'yes':
+            ranges = compact_ranges(ranges)
+        request_data = dict(tagDetails)
+        request_data['ranges'] = ranges
+
         # Update the details of the given tag in the SMC
         request_headers = {'Content-type': 'application/json', 'Accept': 'application/json'}
-        response = self.api_session.request("PUT", url, verify=False, data=json.dumps(tagDetails), headers=request_headers)
+        response = self.request("PUT", url, data=json.dumps(request_data), headers=request_headers)
         # If successfully able to update the tag (host group)
-        updatedTagDetails = json.loads(response.content)["data"]
-        if (response.status_code != 200) or IpAddr in updatedTagDetails["ranges"]:
-            print("Impossible to remove Ip addr from tagId {} (code {}):".format(str(tagId),response.status_code))
+        if (response.status_code == 200):
+            return(self.shadowTag(tagId, json.loads(response.content)["data"]))
+        
+        log.error('smc', "Impossible to update tagId {} (code {}).", tagId, response.status_code)
+        self.dropShadow(tagId)
+        if (response.status_code == 409) and retry: # tag changed in SMC, refresh and retry
+            tagDetails = self.tag_details(tagId, refresh = True)
+            if 'ranges' in tagDetails:
+                return(self.updateTag(tagId, tagDetails, addIPs, delIPs, retry = False))
+        if (response.status_code == 404): # not found, removed from the list
+            self.tags.remove(tagId)
+        return(self.config.smc_unknown_tag())
+    
+    """
+        Sends an API request to SMC, the call is counted (rate, verb/status)
+        and its latency measured
+    """
+    def request(self, verb, url, **kwargs):
+        
+        self.apiRate.monitor()
+        start = time.time()
+        try:
+            response = self.api_session.request(verb, url, verify=False, **kwargs)
+        except Exception:
+            metrics.inc('smc_calls_total', dict(self.labels, verb = verb, status = 'error'))
+            raise
+        metrics.observe('smc_call_seconds', time.time() - start, dict(self.labels, verb = verb))
+        metrics.inc('smc_calls_total', dict(self.labels, verb = verb, status = response.status_code))
+        return(response)
     
     # return the actual API call rate for rate limiting rules
     def callRate(self):
@@ -321,7 +789,711 @@ class SmcControl:
     
         response = self.api_session.delete(self.close_url, timeout=30, verify=False)
         self.req +=1
-        print('Disconnected from SWE')
+        log.info('smc', 'Disconnected from SWE')
+
+"""
+    ---------------------------------------------------------------------------------
+
+    AsyncSmcControl Class : non blocking access to SMC from the asyncio loop
+
+    The API calls of SmcControl are run in a pool of SMC_MAX_CONCURRENCY
+    threads, the event loop (and the pxgrid websocket) is never blocked
+    by a SMC round trip. Lookups served by the local shadow/lists
+    don't leave the loop ; the state they read (tag catalog, shadow,
+    prefix index, call rate) is updated by the threads under a lock.
+    Each API call waits for a token from the limiter, which paces
+    the calls to SMC_MAX_RATE.
+
+    ---------------------------------------------------------------------------------
+"""
+class AsyncSmcControl:
+    def __init__(self, config, smc):
+        self.config = config
+        self.smc = smc
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.smc_max_concurrency())
+        self.limiter = TokenBucket(self.config.smc_max_rate(), self.config.smc_max_burst(), smc.labels)
+        self.inflight = 0
+
+    """
+        Runs a SmcControl method in the thread pool
+    """
+    async def _call(self, method, *args, **kwargs):
+
+        await self.limiter.acquire()
+        self.inflight += 1
+        try:
+            loop = asyncio.get_event_loop()
+            return(await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs)))
+        finally:
+            self.inflight -= 1
+
+    async def authenticate(self):
+        return(await self._call(self.smc.authenticate))
+
+    async def tagList(self):
+        return(await self._call(self.smc.tagList))
+
+    async def tag_details(self, tagId, refresh = False):
+        if self.smc.shadowed(tagId) and not refresh:
+            return(self.smc.tag_details(tagId))
+        return(await self._call(self.smc.tag_details, tagId, refresh))
+
+    async def tagHasIp(self, tagId, IpAddr):
+        if self.smc.shadowed(tagId):
+            return(self.smc.tagHasIp(tagId, IpAddr))
+        return(await self._call(self.smc.tagHasIp, tagId, IpAddr))
+
+    async def createTag(self, tagName):
+        return(await self._call(self.smc.createTag, tagName))
+
+    async def addIp2Tag(self, tagId, tagDetails, IpAddr):
+        return(await self._call(self.smc.addIp2Tag, tagId, tagDetails, IpAddr))
+
+    async def delIpFromTag(self, tagId, tagDetails, IpAddr):
+        return(await self._call(self.smc.delIpFromTag, tagId, tagDetails, IpAddr))
+
+    async def updateTag(self, tagId, tagDetails, addIPs, delIPs):
+        return(await self._call(self.smc.updateTag, tagId, tagDetails, addIPs, delIPs))
+
+    def tagIdFromName(self, tagName):
+        return(self.smc.tagIdFromName(tagName))
+
+    def sgtTags(self):
+        return(self.smc.sgtTags())
+
+    def tagMembers(self, tagId):
+        return(self.smc.tagMembers(tagId))
+
+    def sgtTagsCovering(self, IpAddr):
+        return(self.smc.sgtTagsCovering(IpAddr))
+
+    def callRate(self):
+        return(self.smc.callRate())
+
+    def callIndex(self):
+        return(self.smc.callIndex())
+
+"""
+    ---------------------------------------------------------------------------------
+
+    TokenBucket Class : paces events (SMC API calls) to a max rate
+
+    The bucket holds up to 'burst' tokens and is refilled with 'rate'
+    tokens per second ; each event takes one token.
+     - available() reports the number of tokens left
+     - delay() reports the time before a token is available
+     - acquire() waits for a token (coroutine)
+
+    ---------------------------------------------------------------------------------
+"""
+class TokenBucket:
+    def __init__(self, rate, burst, labels = None):
+        self.rate = rate
+        self.labels = labels # metrics labels
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self):
+        self._refill()
+        return(self.tokens)
+
+    def delay(self):
+        self._refill()
+        if self.tokens >= 1:
+            return(0)
+        return((1 - self.tokens) / self.rate)
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return(True)
+        return(False)
+
+    async def acquire(self):
+        if self.try_acquire():
+            return
+        start = time.time()
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+        waited = time.time() - start
+        metrics.inc('smc_rate_limited_total', self.labels)
+        self.waits += 1
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def stats(self):
+        return({
+            'waits' : self.waits,
+            'avg_wait' : self.wait_time / self.waits if self.waits else 0.0,
+            'max_wait' : self.max_wait
+        })
+
+"""
+    ---------------------------------------------------------------------------------
+
+    PendingQueue Class : pxgrid records waiting for SMC capacity
+
+    Bounded FIFO of @IP -> SGT records ; a new record for an @IP
+    already queued replaces the previous one (latest wins) and keeps
+    its place in the queue. When full, the oldest record is dropped.
+    Format : { ip : (sgtName, enqueue time, due time, flaps) }
+    Held records wait aside (heap ordered by due time) and join the
+    queue once due : the records due are never behind held ones.
+    Filled by the pxgrid reader, emptied by the consumer tasks
+    (wait() / get_batch() / done()).
+    Flap damping : a record changing the SGT of an @IP is held for a
+    settle window (SETTLE_TIME) ; SGT changes within the window reset
+    it, up to SETTLE_MAX_HOLD seconds, and only the final SGT is processed.
+
+    ---------------------------------------------------------------------------------
+"""
+class PendingQueue:
+    def __init__(self, maxsize, max_hold = 0, labels = None):
+        self.maxsize = maxsize
+        self.labels = labels # metrics labels
+        self.max_hold = max_hold
+        self.queue = OrderedDict() # records due
+        self.held = {} # records held, { ip : record }
+        self.heap = [] # [ (due time, ip) ] of the held records, stale items skipped
+        self.max_depth = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.flaps = 0
+        self.processed = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.inflight = {} # { ip : enqueue time } of the records in flight
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def __len__(self):
+        return(len(self.queue) + len(self.held))
+
+    def __contains__(self, IpAddr):
+        return(IpAddr in self.queue or IpAddr in self.held)
+
+    """
+        Queues a record, returns False if an older record was dropped.
+        The record is held for 'hold' seconds (settle window) ; a new SGT
+        for an @IP already queued is a flap : the record is held again,
+        up to max_hold seconds after the first one. A release (sgtName
+        None, see release()) replacing a record, or replaced, isn't a flap.
+    """
+    def put(self, IpAddr, sgtName, hold = 0):
+
+        now = time.time()
+        queued = IpAddr in self.queue
+        record = self.queue.get(IpAddr) if queued else self.held.pop(IpAddr, None)
+        if record != None:
+            self.collapsed += 1
+            oldSgtName, tick, oldDue, flaps = record
+            due = oldDue
+            if sgtName != oldSgtName and sgtName != None and oldSgtName != None:
+                flaps += 1
+                self.flaps += 1
+                metrics.inc('pending_flaps_total', self.labels)
+                due = min(now + hold, tick + self.max_hold)
+            elif sgtName != oldSgtName:
+                # release of the @IP, or back from another tenant
+                flaps = 0
+                due = min(oldDue, now + hold)
+            record = (sgtName, tick, due, flaps)
+            if due > now and (queued or due != oldDue):
+                self.queue.pop(IpAddr, None)
+                self._hold(IpAddr, record)
+            elif due > now:
+                self.held[IpAddr] = record # same due time, still in the heap
+            else:
+                # a record due keeps its place in the queue
+                self.queue[IpAddr] = record
+                self.ready.set()
+            return(True)
+
+        dropped = False
+        if len(self) >= self.maxsize:
+            self._drop()
+            dropped = True
+        if hold > 0:
+            self._hold(IpAddr, (sgtName, now, now + hold, 0))
+        else:
+            self.queue[IpAddr] = (sgtName, now, now, 0)
+            self.ready.set()
+        self.max_depth = max(self.max_depth, len(self))
+        return(not dropped)
+
+    """
+        Queues the release of an @IP routed to another tenant : a record
+        without SGT, due at once (not a flap)
+    """
+    def release(self, IpAddr):
+        return(self.put(IpAddr, None))
+
+    """
+        Keeps a record until its due time ; the consumers are woken up
+        only if it is the next record due
+    """
+    def _hold(self, IpAddr, record):
+
+        self.held[IpAddr] = record
+        due = record[2]
+        heapq.heappush(self.heap, (due, IpAddr))
+        if self.heap[0] == (due, IpAddr):
+            self.ready.set()
+
+    """
+        Top of the heap (due time, ip), stale items removed ; None if empty
+    """
+    def _next_held(self):
+
+        while len(self.heap) > 0:
+            due, IpAddr = self.heap[0]
+            record = self.held.get(IpAddr)
+            if record != None and record[2] == due:
+                return(self.heap[0])
+            heapq.heappop(self.heap)
+        return(None)
+
+    """
+        Moves the held records due (all of them if forced) to the queue
+    """
+    def _release(self, force = False):
+
+        now = time.time()
+        while True:
+            top = self._next_held()
+            if top == None or (top[0] > now and not force):
+                return
+            heapq.heappop(self.heap)
+            self.queue[top[1]] = self.held.pop(top[1])
+
+    """
+        Drops the oldest record (the next held one if none is due)
+    """
+    def _drop(self):
+
+        if len(self.queue) > 0:
+            IpAddr, record = self.queue.popitem(last=False)
+        else:
+            IpAddr = self._next_held()[1]
+            record = self.held.pop(IpAddr)
+        log.warning('queue', " *** Pending queue full ({}), dropping {}/{} record.", self.maxsize, record[0], IpAddr)
+        self.dropped += 1
+        metrics.inc('pending_dropped_total', self.labels)
+
+    """
+        Queues again the record of an @IP whose processing failed, due
+        after 'delay' seconds ; a newer record of the @IP wins.
+    """
+    def retry(self, IpAddr, sgtName, delay):
+
+        if IpAddr in self:
+            return(True)
+        return(self.put(IpAddr, sgtName, delay))
+
+    """
+        Takes the record of an @IP out of the queue, returns its sgtName ;
+        the @IP is in flight until done()
+    """
+    def take(self, IpAddr):
+
+        sgtName, tick, due, flaps = self.queue.pop(IpAddr)
+        waited = time.time() - tick
+        self.processed += 1
+        self.wait_time += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.inflight[IpAddr] = tick
+        if flaps > 0:
+            log.info('flap', "  @IP ({}) settled on sgt {} after {} changes ({:.1f}s).", IpAddr, sgtName, flaps, waited)
+        return(sgtName)
+
+    """
+        Returns up to maxcount of the oldest records due (held records
+        are released first if forced), grouped by SGT : { sgtName : [ IpAddr, ...] }
+        The @IPs are in flight until done() : a newer record for
+        an @IP in flight waits in the queue (per @IP ordering).
+    """
+    def get_batch(self, maxcount = None, force = False):
+
+        self._release(force)
+        if maxcount == None:
+            maxcount = len(self.queue)
+        IpAddrs = []
+        for IpAddr in self.queue:
+            if len(IpAddrs) >= maxcount:
+                break
+            if IpAddr not in self.inflight:
+                IpAddrs.append(IpAddr)
+        batch = OrderedDict()
+        for IpAddr in IpAddrs:
+            batch.setdefault(self.take(IpAddr), []).append(IpAddr)
+        return(batch)
+
+    """
+        Ends the processing of a batch returned by get_batch()
+    """
+    def done(self, batch):
+
+        for ipAddresses in batch.values():
+            for IpAddr in ipAddresses:
+                self.inflight.pop(IpAddr, None)
+        self.ready.set()
+
+    """
+        Number of seconds before the next record (not in flight) is due,
+        None if there is no such record
+        (the records of the queue in flight are at most the batches in progress)
+    """
+    def next_due(self):
+
+        self._release()
+        for IpAddr in self.queue:
+            if IpAddr not in self.inflight:
+                return(0)
+        top = self._next_held()
+        if top == None:
+            return(None)
+        return(max(0, top[0] - time.time()))
+
+    """
+        Waits for records to process, returns False once closed
+    """
+    async def wait(self):
+
+        while not self.closed:
+            delay = self.next_due()
+            if delay == 0:
+                return(True)
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        return(False)
+
+    """
+        Stops the consumers waiting for records
+    """
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+    """
+        Age of the oldest record due (in seconds)
+    """
+    def lag(self):
+
+        if len(self.queue) == 0:
+            return(0.0)
+        sgtName, tick, due, flaps = next(iter(self.queue.values()))
+        return(time.time() - tick)
+
+    def stats(self):
+        return({
+            'depth' : len(self),
+            'held' : len(self.held),
+            'max_depth' : self.max_depth,
+            'collapsed' : self.collapsed,
+            'dropped' : self.dropped,
+            'flaps' : self.flaps,
+            'lag' : self.lag(),
+            'avg_wait' : self.wait_time / self.processed if self.processed else 0.0,
+            'max_wait' : self.max_wait
+        })
+
+"""
+    ---------------------------------------------------------------------------------
+
+    TagBatcher Class : write-behind stage between pxgrid events and SMC
+    (uses the AsyncSmcControl client)
+
+    Pending @IP additions / removals are gathered per tag/group and
+    pushed with one merged update per tag when the batch is flushed.
+    A flush is due after SMC_BATCH_TIME seconds or SMC_BATCH_SIZE changes.
+    Format : { tagId : { ip : True (add) / False (remove) } }
+    The tags are sharded by tagId over SMC_TAG_WORKERS workers : the tags
+    of a worker are updated in sequence, the workers run in parallel
+    (within the SMC_MAX_CONCURRENCY / SMC_MAX_RATE limits of the client).
+    Flushes don't overlap : no two updates of a tag are ever in flight.
+    A change made for a record of the pending queue keeps the enqueue time
+    of the record : its latency (smc_push_seconds) is measured when the
+    flush carrying it succeeds.
+
+    ---------------------------------------------------------------------------------
+"""
+class TagBatcher:
+    def __init__(self, config, smc, inflight = None):
+        self.config = config
+        self.smc = smc
+        self.pending = {}
+        self.size = 0
+        self.first = 0
+        self.inflight = inflight if inflight != None else {} # { ip : enqueue time } of the records processed (PendingQueue)
+        self.ticks = {} # { ip : enqueue time } of the pending changes
+        self.flushing = {} # ticks of the changes being flushed
+        self.latencies = None # list of the latencies, when kept (replay)
+        self.labels = { 'tenant' : self.config.tenant_name() } # metrics labels
+        self.wakeup = asyncio.Event() # set on the first pending change, and when SMC_BATCH_SIZE are pending
+
+    """
+        Records a pending change ; the latest change for an @IP wins.
+    """
+    def _record(self, tagId, IpAddr, add):
+
+        changes = self.pending.setdefault(tagId, {})
+        if IpAddr not in changes:
+            self.size += 1
+        changes[IpAddr] = add
+        tick = self.inflight.get(IpAddr)
+        if tick != None:
+            self.ticks[IpAddr] = min(tick, self.ticks.get(IpAddr, tick))
+        if self.first == 0:
+            # the flush is due in SMC_BATCH_TIME
+            self.first = time.time()
+            self.wakeup.set()
+        if self.size >= self.config.smc_batch_size():
+            self.wakeup.set()
+
+    """
+        Queues an @IP to be added into the tag/group
+    """
+    def add(self, tagId, IpAddr):
+        self._record(tagId, IpAddr, True)
+
+    """
+        Queues an @IP to be removed from the tag/group
+    """
+    def remove(self, tagId, IpAddr):
+        self._record(tagId, IpAddr, False)
+
+    """
+        @IPs with a pending change
+    """
+    def changed(self):
+
+        IpAddrs = set()
+        for changes in self.pending.values():
+            IpAddrs.update(changes)
+        return(IpAddrs)
+
+    """
+        Number of seconds before the next flush is due,
+        None if nothing is pending.
+    """
+    def timeout(self):
+
+        if self.size == 0:
+            return(None)
+        return(max(0, self.first + self.config.smc_batch_time() - time.time()))
+
+    """
+        Checks if the pending changes have to be pushed to SMC
+    """
+    def due(self):
+
+        if self.size == 0:
+            return(False)
+        if self.size >= self.config.smc_batch_size():
+            return(True)
+        return(self.timeout() == 0)
+
+    """
+        Pushes all pending changes to SMC, one update per tag/group.
+        Returns a list of (tagId, tagDetails, changes) ; tagDetails
+        is the unknown tag value if the tag couldn't be updated.
+    """
+    async def flush(self):
+
+        pending = self.pending
+        self.pending = {}
+        self.size = 0
+        self.first = 0
+        self.flushing = self.ticks
+        self.ticks = {}
+        self.wakeup.clear()
+        results = []
+
+        shards = {}
+        for tagId, changes in pending.items():
+            shards.setdefault(hash(tagId) % self.config.smc_tag_workers(), []).append((tagId, changes))
+        await asyncio.gather(*[self._flush_shard(shard, results) for shard in shards.values()])
+
+        # latency of the changes pushed : from the enqueue of their pxgrid record
+        now = time.time()
+        for tagId, tagDetails, changes in results:
+            if 'ranges' not in tagDetails:
+                continue
+            for IpAddr in changes:
+                tick = self.flushing.pop(IpAddr, None)
+                if tick != None:
+                    metrics.observe('smc_push_seconds', now - tick, self.labels)
+                    if self.latencies != None:
+                        self.latencies.append(now - tick)
+        self.flushing = {}
+
+        if len(pending) > 0:
+            metrics.inc('batch_flushes_total', self.labels)
+        return(results)
+
+    """
+        Worker : pushes the changes of its tags, one tag after the other
+    """
+    async def _flush_shard(self, shard, results):
+
+        for tagId, changes in shard:
+            results.append(await self._flush_tag(tagId, changes))
+
+    """
+        Pushes the changes of a tag/group, returns (tagId, tagDetails, changes).
+        On an exception (logged and counted), the changes go back to the
+        next batch, unless a newer change of the @IP is already pending.
+    """
+    async def _flush_tag(self, tagId, changes):
+
+        try:
+            return(await self._update_tag(tagId, changes))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.inc('smc_errors_total', dict(self.labels, stage = 'batch'))
+            log.error('batch', "### Error: tagId ({}) update failed ({!r}), {} changes queued for the next batch.", tagId, e, len(changes))
+            newer = self.pending.get(tagId, {})
+            for IpAddr, add in changes.items():
+                if IpAddr not in newer:
+                    self._record(tagId, IpAddr, add)
+                    if IpAddr in self.flushing:
+                        self.ticks.setdefault(IpAddr, self.flushing[IpAddr])
+            return((tagId, self.config.smc_unknown_tag(), {}))
+
+    """
+        Pushes the changes of a tag : one merged update, only for the
+        @IPs not already as expected in SMC
+    """
+    async def _update_tag(self, tagId, changes):
+
+        tagDetails = await self.smc.tag_details(tagId) # shadow lookup, or smc API; one query
+        if 'ranges' not in tagDetails:
+            log.error('batch', "### Error: Impossible to get the tagId ({}) details, {} changes not processed.", tagId, len(changes))
+            return((tagId, tagDetails, changes))
+
+        addIPs = []
+        delIPs = []
+        for IpAddr, add in changes.items():
+            if add != await self.smc.tagHasIp(tagId, IpAddr):
+                if add:
+                    addIPs.append(IpAddr)
+                else:
+                    delIPs.append(IpAddr)
+        if len(addIPs) > 0 or len(delIPs) > 0:
+            if log.enabled(INFO, 'batch'):
+                log.info('batch', "  Tag ({}), batch update : +{} / -{} @IPs - rate/s : {:.1f}.", tagDetails['name'], len(addIPs), len(delIPs), self.smc.callRate())
+            tagDetails = await self.smc.updateTag(tagId, tagDetails, addIPs, delIPs) # smc API; one query
+        else:
+            log.info('batch', "  Tag ({}), {} @IPs already up to date in SMC, no change.", tagDetails['name'], len(changes))
+        return((tagId, tagDetails, changes))
+
+"""
+    ---------------------------------------------------------------------------------
+
+    Reconciler Class : periodic diff between the IpCache and SMC tags/groups
+
+    Every RECONCILE_TIME, each SGT managed tag is fetched once from SMC
+    and compared with the cache :
+     - @IPs in the cache but missing in SMC are added
+     - @IPs in SMC but cached in another tag are removed
+     - @IPs in SMC unknown in the cache are loaded in the cache
+    A run stops after RECONCILE_MAX_CALLS API calls ; calls are paced by the
+    SMC rate limiter, together with the live traffic.
+
+    ---------------------------------------------------------------------------------
+"""
+class Reconciler:
+    def __init__(self, config, smc, ipTags):
+        self.config = config
+        self.smc = smc
+        self.ipTags = ipTags
+        self.lastrun = int(time.time())
+        self.offset = 0 # first tag of the next run, when a run is over budget
+
+    def due(self):
+        return(self.timeout() == 0)
+
+    """
+        Number of seconds before the next run, None if disabled
+    """
+    def timeout(self):
+        if self.config.reconcile_time() == 0:
+            return(None)
+        return(max(0, self.lastrun + self.config.reconcile_time() - time.time()))
+
+    """
+        Compares the managed tags with the cache and fixes SMC.
+        Returns the report : { 'tags' : [(tagName, added, removed, loaded)], 'calls' : n }
+    """
+    async def run(self):
+
+        self.lastrun = int(time.time())
+        budget = self.config.reconcile_max_calls()
+        tags = self.smc.sgtTags()
+        # rotate the tags, the ones skipped by a previous run go first
+        if self.offset >= len(tags):
+            self.offset = 0
+        tags = tags[self.offset:] + tags[:self.offset]
+
+        # expected tag members, from the cache
+        expected = {}
+        for IpAddr, entry in self.ipTags.cache.items():
+            expected.setdefault(entry.id, set()).add(IpAddr)
+
+        calls = 0
+        checked = 0
+        report = []
+        for tag in tags:
+            if calls + 2 > budget: # one GET, and maybe one PUT
+                log.info('reconcile', "* Reconciliation budget reached ({} calls), {} tags left for the next run.", calls, len(tags) - checked)
+                break
+            tagId = tag['id']
+            tagDetails = await self.smc.tag_details(tagId, refresh = True) # smc API; one query
+            calls += 1
+            checked += 1
+            if 'ranges' not in tagDetails:
+                continue
+
+            actual = self.smc.tagMembers(tagId) # CIDR/range entries expanded
+            members = expected.get(tagId, set())
+            addIPs = members - actual
+            delIPs = []
+            loadIPs = []
+            for IpAddr in actual - members:
+                cachedTagId = self.ipTags.peek(IpAddr) # not a lookup, not counted
+                if cachedTagId == None:
+                    loadIPs.append(IpAddr)
+                elif cachedTagId != tagId:
+                    delIPs.append(IpAddr)
+            self.ipTags.sync(tagId, loadIPs)
+
+            if len(addIPs) > 0 or len(delIPs) > 0:
+                log.debug('reconcile', "  -- Tag ({}) : adding {}, removing {}.", tagDetails['name'], sorted(addIPs), sorted(delIPs))
+                await self.smc.updateTag(tagId, tagDetails, list(addIPs), delIPs) # smc API; one query
+                calls += 1
+            if len(addIPs) > 0 or len(delIPs) > 0 or len(loadIPs) > 0:
+                report.append((tagDetails['name'], len(addIPs), len(delIPs), len(loadIPs)))
+
+        self.offset = (self.offset + checked) % max(1, len(tags))
+
+        log.info('reconcile', "* {} : reconciliation, {} tags checked, {} API calls.", time.strftime("%m-%d %H:%M:%S", time.gmtime()), checked, calls)
+        for tagName, added, removed, loaded in report:
+            log.info('reconcile', "  -- Tag ({}) : {} @IPs added, {} removed in SMC, {} loaded in cache.", tagName, added, removed, loaded)
+        return({ 'tags' : report, 'calls' : calls })
 
 """
     ---------------------------------------------------------------------------------
@@ -329,17 +1501,33 @@ class SmcControl:
     IpCache Class : IP@ <-> group/tag entries cache
     
     Avoids to fire an API call to SMC if the @IP was seen recently
-    Format : { ip : tag }
+    Format : { ip : IpEntry(tag, tick) }
+    
+    Entries are kept in tick order (oldest first) : every tick update
+    moves the entry at the end, the review only visits expired entries.
+    
+    The cache is saved every CACHE_SNAPSHOT_TIME into the CACHE_SNAPSHOT_FILE
+    SQLite file, and loaded from it at startup (warm restart).
     
     ---------------------------------------------------------------------------------
 
 """
+class IpEntry:
+    __slots__ = ('id', 'tick')
+    
+    def __init__(self, tagId, tick):
+        self.id = tagId
+        self.tick = tick
+
 class IpCache:
     def __init__(self, config):
         # Initialize the cache
         self.config = config
-        self.cache = {}
+        self.cache = OrderedDict()
         self.lastcleanup = int(time.time())
+        self.lastsnapshot = int(time.time())
+        self.review_stats = { 'duration' : 0.0, 'visited' : 0, 'stale' : 0 }
+        self.labels = { 'tenant' : self.config.tenant_name() } # metrics labels
     
     """
         Updates an entry in the cache, and returns the old value
@@ -347,32 +1535,44 @@ class IpCache:
     """
     def update(self,ip, tagId):
         
-        tick = int(time.time())
-        tag = { 'id' : tagId, 'tick' : tick }
-        oldTagId = self.exists(ip)
+        entry = self.cache.get(ip)
         
-        if oldTagId == None:
+        if entry == None:
             # add the entry in the cache
-            self.cache.update({ ip : tag })
+            self.cache[ip] = IpEntry(tagId, int(time.time()))
             return(None)
         else:
             # IP already exists in the cache
-            if tagId == oldTagId:
+            if tagId == entry.id:
                 # tag hasn't changed
                 return(None)
             else:
                 # tag changed, updating and returning the old one
-                self.cache.update({ ip : tag })
+                oldTagId = entry.id
+                entry.id = tagId
+                entry.tick = int(time.time())
+                self.cache.move_to_end(ip)
                 return(oldTagId)
     
+    """
+        Tag of an @IP in the cache (None if unknown), not counted as a lookup
+    """
+    def peek(self, ip):
+
+        entry = self.cache.get(ip)
+        return(entry.id if entry != None else None)
+
     """
         Checks if an @IP exists in the cache
     """
     def exists(self, ip):
         
-        if ip in self.cache.keys():
-            return(self.cache[ip]['id'])
+        entry = self.cache.get(ip)
+        if entry != None:
+            metrics.inc('cache_lookups_total', dict(self.labels, result = 'hit'))
+            return(entry.id)
         else:
+            metrics.inc('cache_lookups_total', dict(self.labels, result = 'miss'))
             return(None)
     
     """
@@ -380,16 +1580,16 @@ class IpCache:
     """
     def delete(self, IpAddr):
     
-        if self.exists(IpAddr) != None:
-            del self.cache[IpAddr]
+        self.cache.pop(IpAddr, None)
     
     """
         Retrieve the latest time an @IP has been updated
     """
     def last(self, ip):
         
-        if ip in self.cache.keys():
-            return(self.cache[ip]['tick'])
+        entry = self.cache.get(ip)
+        if entry != None:
+            return(entry.tick)
         else:
             return(0)
 
@@ -400,25 +1600,27 @@ class IpCache:
     """
     def confirm(self, ip):
     
-        tagId = self.exists(ip)
-        if tagId:
-            tick = int(time.time())
-            tag = { 'id' : tagId, 'tick' : tick }
-            self.cache.update({ ip : tag })
-            return(tick)
+        entry = self.cache.get(ip)
+        if entry != None and entry.id:
+            entry.tick = int(time.time())
+            self.cache.move_to_end(ip)
+            return(entry.tick)
         else:
             return(0)
     
     """
         Updates a list of @IPs an entry in the cache
+        (CIDR/range entries are not cached, @IPs in skip are left as is)
     """
-    def sync(self, tagId, IpAddresses):
+    def sync(self, tagId, IpAddresses, skip = ()):
     
         for IpAddr in IpAddresses:
-            self.update(IpAddr,tagId)
+            if is_single_ip(IpAddr) and IpAddr not in skip:
+                self.update(IpAddr,tagId)
     
     """
         Removes stale entries in the cache
+        (only the oldest entries, up to the first one not expired, are visited)
     """
     def review(self):
     
@@ -426,47 +1628,237 @@ class IpCache:
         staleIPs = []
 
         if now - self.lastcleanup > self.config.cache_cleanup_time():
-            print('* {} : cache review.'.format(time.strftime("%m-%d %H:%M:%S", time.gmtime())))
-            for IpAddr in self.cache.keys():
-                age = now - self.last(IpAddr)
-                if age > self.config.cache_stale_ip():
-                    localtime = time.localtime(now)
-                    print('  -- {} age = {} (sec).'.format(IpAddr,age))
-                    staleIPs.append(IpAddr)
-                    
+            start = time.time()
+            visited = 0
+            for IpAddr, entry in self.cache.items():
+                visited += 1
+                age = now - entry.tick
+                if age <= self.config.cache_stale_ip():
+                    break
+                log.info('stale', '  -- {} age = {} (sec).', IpAddr, age)
+                staleIPs.append(IpAddr)
+            
+            self.review_stats = {
+                'duration' : time.time() - start,
+                'visited' : visited,
+                'stale' : len(staleIPs)
+            }
+            log.info('cache', '* {} : cache review, {} stale / {} entries ({:.1f} kB), {:.1f} ms.', time.strftime("%m-%d %H:%M:%S", time.gmtime()),
+                len(staleIPs), len(self.cache), self.memory() / 1024, self.review_stats['duration'] * 1000)
             self.lastcleanup = now
         
         return(staleIPs)
+    
+    """
+        Approximate memory used by the cache (in bytes)
+    """
+    def memory(self):
+        
+        if len(self.cache) == 0:
+            return(sys.getsizeof(self.cache))
+        entry = next(iter(self.cache.values()))
+        return(sys.getsizeof(self.cache) + len(self.cache) * sys.getsizeof(entry))
+    
+    """
+        Saves the cache entries (ip, tagId, tick) into the snapshot file.
+        The file is written aside and renamed, a crash during the
+        save doesn't corrupt the previous snapshot.
+    """
+    def save(self, entries = None):
+        
+        filename = self.config.cache_snapshot_file()
+        if filename == '':
+            return(False)
+        if entries == None:
+            entries = [(ip, entry.id, entry.tick) for ip, entry in self.cache.items()]
+        
+        tmpname = filename + '.tmp'
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        try:
+            db = sqlite3.connect(tmpname)
+            db.execute('PRAGMA journal_mode = OFF')
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('CREATE TABLE cache (ip TEXT, tag, tick INTEGER)')
+            db.executemany('INSERT INTO cache VALUES (?, ?, ?)', entries)
+            db.commit()
+            db.close()
+            os.replace(tmpname, filename)
+        except (sqlite3.Error, OSError) as e:
+            log.error('cache', "## Cannot save the cache snapshot into {} : {}", filename, e)
+            return(False)
+        return(True)
+    
+    """
+        Loads the cache entries from the snapshot file (in tick order)
+    """
+    def load(self):
+        
+        filename = self.config.cache_snapshot_file()
+        if filename == '' or not os.path.exists(filename):
+            return(0)
+        try:
+            db = sqlite3.connect(filename)
+            for ip, tagId, tick in db.execute('SELECT ip, tag, tick FROM cache ORDER BY rowid'):
+                self.cache[ip] = IpEntry(tagId, tick)
+            db.close()
+        except sqlite3.Error as e:
+            log.error('cache', "## Cannot load the cache snapshot from {} : {}", filename, e)
+            self.cache.clear()
+        log.info('cache', "* Cache snapshot loaded from {} : {} entries.", filename, len(self.cache))
+        return(len(self.cache))
+    
+    """
+        Saves the cache every CACHE_SNAPSHOT_TIME ; entries are
+        copied in the loop and written from a thread.
+    """
+    async def snapshot(self, force = False):
+        
+        now = int(time.time())
+        if self.config.cache_snapshot_file() == '':
+            return
+        if not force and now - self.lastsnapshot < self.config.cache_snapshot_time():
+            return
+        self.lastsnapshot = now
+        entries = [(ip, entry.id, entry.tick) for ip, entry in self.cache.items()]
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.save, entries)
+    
+    """
+        Cache statistics, including the latest review
+    """
+    def stats(self):
+        
+        stats = dict(self.review_stats)
+        stats['size'] = len(self.cache)
+        stats['memory'] = self.memory()
+        return(stats)
             
 """
     ---------------------------------------------------------------------------------
     
     Speedo Class used to rate the number of events (calls, messages, etc) per second
     
+    Events are counted in a fixed ring of 1 second buckets, covering
+    the longest window (60 seconds per default) ; memory and cost
+    don't depend on the event rate.
     Calculation made on the latest 5 seconds (per default)
      - monitor() takes the event in account
-     - rate() reports the average of events / s
+     - rate() reports the average of events / s (on 'lapse' or on a given window)
      - index() provides the actual index
+    Events may be counted from several threads (SMC calls).
      
     ---------------------------------------------------------------------------------
 """
 class Speedo:
-    def __init__(self, lapse = 5):
+    def __init__(self, lapse = 5, windows = (1, 5, 60)):
+        self.lock = threading.Lock()
         self.req = 0
-        self.req_clock = []
         self.lapse = lapse # in seconds
+        self.windows = windows
+        self.size = max(max(windows), lapse)
+        self.buckets = [0] * self.size
+        self.seconds = [0] * self.size # second held by each bucket
         
     def monitor(self):
-        self.req +=1
-        self.req_clock.append(time.time())
+        now = int(time.time())
+        slot = now % self.size
+        with self.lock:
+            self.req +=1
+            if self.seconds[slot] != now:
+                # bucket reused for the actual second
+                self.seconds[slot] = now
+                self.buckets[slot] = 0
+            self.buckets[slot] += 1
     
-    def rate(self):
-        now = time.time()
-        for item in self.req_clock:
-            if now - item > self.lapse: # rate calculated on self.lapse period of time
-                self.req_clock.remove(item)
-        rate = len(self.req_clock) / self.lapse
+    def rate(self, window = None):
+        if window == None:
+            window = self.lapse # rate calculated on self.lapse period of time
+        window = min(window, self.size)
+        now = int(time.time())
+        count = 0
+        with self.lock:
+            for second in range(now - window + 1, now + 1):
+                slot = second % self.size
+                if self.seconds[slot] == second:
+                    count += self.buckets[slot]
+        rate = count / window
         return(rate)
     
+    # rates for all configured windows
+    def rates(self):
+        return({ window : self.rate(window) for window in self.windows })
+    
     def index(self):
         return self.req
+
+"""
+    ---------------------------------------------------------------------------------
+
+    SmcTenant Class : the agent objects of a SMC tenant (domain)
+
+    Each tenant has its own SMC session and tag catalog (SmcControl),
+    rate budget and thread pool (AsyncSmcControl), IpCache, pending
+    queue, batcher and reconciler ; config is the TenantConfig of the
+    tenant (SMC_TENANTS entry).
+
+    ---------------------------------------------------------------------------------
+"""
+class SmcTenant:
+    def __init__(self, config):
+        self.config = config
+        self.name = config.tenant_name()
+        self.smc = SmcControl(config)
+        self.asyncSmc = AsyncSmcControl(config, self.smc)
+        self.ipTags = IpCache(config)
+        self.pending = PendingQueue(config.smc_pending_size(), config.settle_max_hold(), { 'tenant' : self.name })
+        self.batcher = TagBatcher(config, self.asyncSmc, self.pending.inflight)
+        self.reconciler = Reconciler(config, self.asyncSmc, self.ipTags)
+        self.tagCreations = {} # sgtName : tag creation in progress
+
+    """
+        SMC environment of the tenant : authentication, tenant ID,
+        tags/groups and SGT parent tags (blocking, at startup)
+    """
+    def setup(self):
+        self.smc.authenticate()
+        self.smc.get_tenantID()
+        self.smc.tagList()
+        self.smc.setSgtRootTags()
+
+"""
+    ---------------------------------------------------------------------------------
+
+    TenantRouter Class : selects the tenant receiving an @IP / SGT binding
+
+    Tenants are checked in the SMC_TENANTS order, the first one matching
+    gets the binding : SGT in its 'sgts' and @IP in one of its 'prefixes'
+    (indexed in an IpPrefixIndex, by tenant position) ; a tenant without
+    'sgts' or 'prefixes' matches any SGT or @IP.
+     - route() returns the tenant, None if no tenant matches
+
+    ---------------------------------------------------------------------------------
+"""
+class TenantRouter:
+    def __init__(self, tenants):
+        self.rules = [] # (tenant, sgts, prefixes defined)
+        self.index = IpPrefixIndex()
+        for position, tenant in enumerate(tenants):
+            prefixes = tenant.config.tenant_prefixes()
+            for prefix in prefixes:
+                self.index.add(prefix, position)
+            self.rules.append((tenant, set(tenant.config.tenant_sgts()), len(prefixes) > 0))
+
+    def route(self, IpAddr, sgtName):
+
+        covering = None
+        for position, (tenant, sgts, prefixed) in enumerate(self.rules):
+            if len(sgts) > 0 and sgtName not in sgts:
+                continue
+            if prefixed:
+                if covering == None:
+                    covering = self.index.covering(IpAddr)
+                if position not in covering:
+                    continue
+            return(tenant)
+        return(None)
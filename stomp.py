@@ -1,4 +1,18 @@
 import io
+import re
+
+# end of the headers : blank line (EOL is LF or CRLF)
+HEADERS_END = re.compile(b'\r?\n\r?\n')
+
+# header value escapes (STOMP 1.2), not applied to CONNECT / CONNECTED frames
+ESCAPES = {'\\n': '\n', '\\r': '\r', '\\c': ':', '\\\\': '\\'}
+ESCAPED = re.compile(r'\\[nrc\\]')
+
+
+def unescape(value):
+    if '\\' not in value:
+        return value
+    return ESCAPED.sub(lambda match: ESCAPES[match.group(0)], value)
 
 
 class StompFrame:
@@ -6,6 +20,7 @@ class StompFrame:
         self.headers = {}
         self.command = None
         self.content = None
+        self.body = None
 
     def get_command(self):
         return self.command
@@ -14,8 +29,14 @@ class StompFrame:
         self.command = command
 
     def get_content(self):
+        if self.content is None and self.body is not None:
+            self.content = self.body.decode('utf-8')
         return self.content
 
+    # raw body (bytes) of a frame read by StompParser
+    def get_body(self):
+        return self.body
+
     def set_content(self, content):
         self.content = content
 
@@ -46,7 +67,83 @@ class StompFrame:
             line = line.rstrip('\r\n')
             if line == '':
                 break
-            (name, value) = line.split(':')
+            (name, value) = line.split(':', 1)
             frame.headers[name] = value
         frame.content = input.read()[:-1]
         return frame
+
+
+class StompParser:
+    """
+    Bytes based STOMP parser: websocket payloads are fed as they come,
+    complete frames are returned. A payload may hold several frames,
+    a frame may be split across payloads. The body is delimited by the
+    content-length header when present (it may then contain NUL bytes),
+    by the NUL byte otherwise, and kept as bytes (json.loads accepts them).
+    A malformed frame is skipped (up to its NUL byte) and its error kept
+    in errors, the frames after it are still returned.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.errors = []
+
+    def feed(self, data):
+        self.buffer += data
+
+    # returns the complete frames received, the rest is kept for the next feed
+    def frames(self):
+        frames = []
+        pos = 0
+        with memoryview(self.buffer) as view:
+            while True:
+                try:
+                    frame, pos = self._parse(view, pos)
+                except ValueError as e:
+                    self.errors.append(e)
+                    end = self.buffer.find(b'\0', pos)
+                    pos = len(self.buffer) if end < 0 else end + 1
+                    continue
+                if frame is None:
+                    break
+                frames.append(frame)
+        if pos > 0:
+            del self.buffer[:pos]
+        return frames
+
+    # returns (frame, position after the frame) or (None, position) if incomplete
+    def _parse(self, view, pos):
+        buffer = self.buffer
+        # EOLs between frames (heart-beats)
+        while pos < len(buffer) and buffer[pos] in (10, 13):
+            pos += 1
+        match = HEADERS_END.search(buffer, pos)
+        if match is None:
+            return None, pos
+
+        lines = str(view[pos:match.start()], 'utf-8').split('\n')
+        frame = StompFrame()
+        frame.command = lines[0].rstrip('\r')
+        escaped = frame.command not in ('CONNECT', 'CONNECTED')
+        for line in lines[1:]:
+            line = line.rstrip('\r')
+            if ':' not in line:
+                continue
+            (name, value) = line.split(':', 1)
+            if escaped:
+                name, value = unescape(name), unescape(value)
+            if name not in frame.headers:  # first occurrence wins
+                frame.headers[name] = value
+
+        start = match.end()
+        if 'content-length' in frame.headers:
+            end = start + int(frame.headers['content-length'])
+            if end >= len(buffer):
+                return None, pos
+            if buffer[end] != 0:
+                raise ValueError('STOMP frame body longer than content-length')
+        else:
+            end = buffer.find(b'\0', start)
+            if end < 0:
+                return None, pos
+        frame.body = bytes(view[start:end]) # b'' for an empty body
+        return frame, end + 1
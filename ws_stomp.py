@@ -1,7 +1,14 @@
 import base64
+import gzip
+import json
+import time
 import websockets
+from collections import deque
 from io import StringIO
-from stomp import StompFrame
+from stomp import StompFrame, StompParser
+
+CAPTURE_FLUSH_RECORDS = 100
+CAPTURE_FLUSH_TIME = 1.0
 
 
 class WebSocketStomp:
@@ -11,6 +18,32 @@ class WebSocketStomp:
         self.password = password
         self.ssl_ctx = ssl_ctx
         self.ws = None
+        self.capture = None
+        self.captured = 0
+        self.capture_flushed = 0
+        self.parser = StompParser()
+        self.frames = deque()
+
+    # raw MESSAGE payloads are written with their timestamp
+    # into a gzip file of JSON lines (replay input)
+    def start_capture(self, filename):
+        self.capture = gzip.open(filename, 'at', encoding='utf-8')
+        self.capture_flushed = time.time()
+
+    # sync flush every CAPTURE_FLUSH_RECORDS records or CAPTURE_FLUSH_TIME
+    # seconds: the records written are readable even if the process is killed
+    def write_capture(self, message):
+        now = time.time()
+        self.capture.write(json.dumps({'time': now, 'message': message}) + '\n')
+        self.captured += 1
+        if self.captured % CAPTURE_FLUSH_RECORDS == 0 or now - self.capture_flushed >= CAPTURE_FLUSH_TIME:
+            self.capture.flush()
+            self.capture_flushed = now
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
 
     async def connect(self):
         b64 = base64.b64encode(
@@ -51,14 +84,23 @@ class WebSocketStomp:
         frame.write(out)
         await self.ws.send(out.getvalue().encode('utf-8'))
 
-    # only returns for MESSAGE
+    # only returns for MESSAGE, the body is returned as bytes
     async def stomp_read_message(self):
         while True:
-            message = await self.ws.recv()
-            s_in = StringIO(message.decode('utf-8'))
-            stomp = StompFrame.parse(s_in)
+            while len(self.frames) == 0:
+                message = await self.ws.recv()
+                if isinstance(message, str):
+                    message = message.encode('utf-8')
+                self.parser.feed(message)
+                self.frames.extend(self.parser.frames())
+                if len(self.parser.errors) > 0:
+                    # the valid frames stay queued for the next calls
+                    raise self.parser.errors.pop(0)
+            stomp = self.frames.popleft()
             if stomp.get_command() == 'MESSAGE':
-                return stomp.get_content()
+                if self.capture is not None:
+                    self.write_capture(stomp.get_content())
+                return stomp.get_body()
             elif stomp.get_command() == 'CONNECTED':
                 version = stomp.get_header('version')
                 print('STOMP CONNECTED version=' + version)
@@ -66,7 +108,7 @@ class WebSocketStomp:
                 receipt = stomp.get_header('receipt-id')
                 print('STOMP RECEIPT id=' + receipt)
             elif stomp.get_command() == 'ERROR':
-                print('STOMP ERROR content=' + stomp.get_content())
+                print('STOMP ERROR content=' + (stomp.get_content() or ''))
 
     async def stomp_disconnect(self, receipt=None):
         print('STOMP DISCONNECT receipt=' + receipt)